@@ -395,3 +395,2922 @@ with open("replay.json", "w") as f:
 # - Using carts to deliver resources from far away clusters of wood, coal, uranium to a city in need
 # - Sending worker units over to the opponent's roads and pillaging them to slow down their agent
 # - Optimizing over how much to mine out of forests before letting them regrow so you can build more cities and get sustainable fuel
+
+
+# ## Making the Agent Faster
+# 
+# Kaggle gives every agent a limited amount of time per turn, and the helpers above were written to be easy to read rather than fast. The rest of this notebook swaps them out piece by piece for versions that do less work per turn while making the same decisions.
+# 
+# ### A persistent resource index
+# 
+# `find_resources` walks every one of the width x height cells of the map each turn just to collect the handful that hold resources. The observation already lists every resource tile as a line of the form `r <type> <x> <y> <amount>`, and from one turn to the next only the tiles that were mined (or that regrew) change. So instead of rescanning the map we keep an index that is built once at step 0 and then only touches the resource lines that differ from the previous turn. Tiles are bucketed by resource type, and depleted tiles are dropped from the index.
+
+# In[20]:
+
+
+# an index of resource tiles that persists across turns, bucketed by resource type and keyed by (x, y)
+class ResourceIndex:
+    def __init__(self):
+        self.tiles = {
+            Constants.RESOURCE_TYPES.WOOD: {},
+            Constants.RESOURCE_TYPES.COAL: {},
+            Constants.RESOURCE_TYPES.URANIUM: {},
+        }
+        # bumped every time a tile of that type appears or is depleted, so other caches know when to rebuild
+        self.versions = {r_type: 0 for r_type in self.tiles}
+        self._lines = set()
+        self._ordered = None
+
+    def update(self, updates):
+        # resource lines start with "r " (research points lines start with "rp"). Only the lines that differ
+        # from last turn need any work: a tile that was mined shows up as one removed and one added line
+        lines = {update for update in updates if update.startswith("r ")}
+        added = [line.split(" ") for line in lines - self._lines]
+        removed = [line.split(" ") for line in self._lines - lines]
+        self._lines = lines
+        updated = set()
+        for _, r_type, x, y, amount in added:
+            pos = (int(x), int(y))
+            amount = int(float(amount))
+            bucket = self.tiles[r_type]
+            if amount <= 0:
+                continue
+            if pos not in bucket:
+                self.versions[r_type] += 1
+                self._ordered = None
+            bucket[pos] = amount
+            updated.add(pos)
+        for _, r_type, x, y, _ in removed:
+            pos = (int(x), int(y))
+            # the tile is no longer listed (or listed as empty), so it has been depleted
+            if pos not in updated and self.tiles[r_type].pop(pos, None) is not None:
+                self.versions[r_type] += 1
+                self._ordered = None
+
+    def positions(self):
+        # all indexed tiles in the same row by row order find_resources uses, so ties are broken the same way
+        if self._ordered is None:
+            self._ordered = sorted(
+                ((x, y, r_type) for r_type, bucket in self.tiles.items() for (x, y) in bucket),
+                key=lambda tile: (tile[1], tile[0]),
+            )
+        return self._ordered
+
+    def cells(self, game_state):
+        # the Game object creates new Cell objects every turn, so we look the current ones up by position
+        get_cell = game_state.map.get_cell
+        return [get_cell(x, y) for x, y, _ in self.positions()]
+
+
+# drop-in replacement for find_resources that reads from the index instead of scanning the whole map
+def find_resources_indexed(game_state, resource_index):
+    return resource_index.cells(game_state)
+
+
+# Since the game we ran earlier is still sitting in `game_state`, we can check that the index finds exactly the same tiles, in the same order, as a full scan of the map
+
+# In[21]:
+
+
+resource_index = ResourceIndex()
+resource_index.update(steps[-1][0]["observation"]["updates"])
+game_state._update(steps[-1][0]["observation"]["updates"])
+assert [cell.pos for cell in find_resources_indexed(game_state, resource_index)] == [cell.pos for cell in find_resources(game_state)]
+print(len(resource_index.positions()), "resource tiles indexed")
+
+
+# Now our agent builds the index at step 0 and keeps it up to date alongside `game_state`
+
+# In[22]:
+
+
+game_state = None
+resource_index = None
+def agent(observation, configuration):
+    global game_state, resource_index
+
+    ### Do not edit ###
+    if observation["step"] == 0:
+        game_state = Game()
+        game_state._initialize(observation["updates"])
+        game_state._update(observation["updates"][2:])
+        game_state.id = observation.player
+    else:
+        game_state._update(observation["updates"])
+    
+    actions = []
+
+    ### AI Code goes down here! ### 
+    player = game_state.players[observation.player]
+    opponent = game_state.players[(observation.player + 1) % 2]
+    width, height = game_state.map.width, game_state.map.height
+
+    if observation["step"] == 0:
+        resource_index = ResourceIndex()
+    resource_index.update(observation["updates"])
+
+    resource_tiles = find_resources_indexed(game_state, resource_index)
+    
+    for unit in player.units:
+        # if the unit is a worker (can mine resources) and can perform an action this turn
+        if unit.is_worker() and unit.can_act():
+            # we want to mine only if there is space left in the worker's cargo
+            if unit.get_cargo_space_left() > 0:
+                # find the closest resource if it exists to this unit
+                closest_resource_tile = find_closest_resources(unit.pos, player, resource_tiles)
+                if closest_resource_tile is not None:
+                    # create a move action to move this unit in the direction of the closest resource tile and add to our actions list
+                    action = unit.move(unit.pos.direction_to(closest_resource_tile.pos))
+                    actions.append(action)
+            else:
+                # find the closest citytile and move the unit towards it to drop resources to a citytile to fuel the city
+                closest_city_tile = find_closest_city_tile(unit.pos, player)
+                if closest_city_tile is not None:
+                    # create a move action to move this unit in the direction of the closest resource tile and add to our actions list
+                    action = unit.move(unit.pos.direction_to(closest_city_tile.pos))
+                    actions.append(action)
+    
+    return actions
+
+
+# In[23]:
+
+
+env = make("lux_ai_2021", configuration={"seed": 562124210, "loglevel": 2, "annotations": True}, debug=True)
+steps = env.run([agent, "simple_agent"])
+env.render(mode="ipython", width=1200, height=800)
+
+
+# ### Nearest tiles in constant time
+# 
+# Even with the index, `find_closest_resources` and `find_closest_city_tile` compare every unit against every tile, which is hundreds times hundreds of distance calculations a turn in the late game. Tiles appear and disappear far less often than units move though, so we can precompute, for every cell of the map, which tile is closest to it. A breadth first search that starts from all tiles at once fills in the whole map in one pass, and after that finding the closest tile for a unit is a single lookup.
+# 
+# The one thing to be careful about is ties. The linear scans only replace their answer when they find something strictly closer, so among equally close tiles the one that comes first in the list wins. The search below keeps the same rule by letting each cell remember the earliest tile that reaches it, which means the agent makes exactly the same moves as before.
+
+# In[24]:
+
+
+# for every cell of the map, the Manhattan distance to the nearest of a list of (x, y) positions and the index of that
+# position in the list. When several positions are equally close the one that comes first in the list wins
+class NearestField:
+    def __init__(self, width, height, positions):
+        self.width = width
+        self.height = height
+        self.dist = [-1] * (width * height)
+        self.best = [-1] * (width * height)
+        frontier = []
+        for i, (x, y) in enumerate(positions):
+            cell = y * width + x
+            if self.best[cell] == -1:
+                self.dist[cell] = 0
+                self.best[cell] = i
+                frontier.append(cell)
+        d = 0
+        while frontier:
+            d += 1
+            reached = {}
+            for cell in frontier:
+                x, y = cell % width, cell // width
+                best = self.best[cell]
+                for nx, ny in ((x, y - 1), (x + 1, y), (x, y + 1), (x - 1, y)):
+                    if 0 <= nx < width and 0 <= ny < height:
+                        neighbour = ny * width + nx
+                        if self.dist[neighbour] == -1 and best < reached.get(neighbour, math.inf):
+                            reached[neighbour] = best
+            # on a grid without obstacles the nearest positions of a cell at distance d are exactly the nearest
+            # positions of its neighbours at distance d - 1, so keeping the smallest index settles the tie rule
+            for cell, best in reached.items():
+                self.dist[cell] = d
+                self.best[cell] = best
+            frontier = list(reached)
+
+    def lookup(self, x, y):
+        # returns (distance, index), or (-1, -1) if there were no positions at all
+        cell = y * self.width + x
+        return self.dist[cell], self.best[cell]
+
+
+# keeps one NearestField per resource type and one for our own city tiles, and only rebuilds a field when its tiles change
+class SpatialIndex:
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.game_state = None
+        self.resource_fields = {}
+        self.city_tiles = []
+        self.city_positions = None
+        self.city_field = None
+
+    def update(self, game_state, resource_index, player):
+        self.game_state = game_state
+        for r_type, version in resource_index.versions.items():
+            cached = self.resource_fields.get(r_type)
+            if cached is None or cached[0] != version:
+                positions = [(x, y) for x, y, tile_type in resource_index.positions() if tile_type == r_type]
+                self.resource_fields[r_type] = (version, positions, NearestField(self.width, self.height, positions))
+        # city tiles are listed in the same order find_closest_city_tile visits them
+        self.city_tiles = [city_tile for city in player.cities.values() for city_tile in city.citytiles]
+        positions = tuple((city_tile.pos.x, city_tile.pos.y) for city_tile in self.city_tiles)
+        if positions != self.city_positions:
+            self.city_positions = positions
+            self.city_field = NearestField(self.width, self.height, positions)
+
+    def closest_resource(self, pos, player):
+        # same answer as find_closest_resources: closest mineable tile, ties broken by row then column
+        closest = None
+        for r_type, (_, positions, field) in self.resource_fields.items():
+            # we skip over resources that we can't mine due to not having researched them
+            if r_type == Constants.RESOURCE_TYPES.COAL and not player.researched_coal(): continue
+            if r_type == Constants.RESOURCE_TYPES.URANIUM and not player.researched_uranium(): continue
+            dist, i = field.lookup(pos.x, pos.y)
+            if i == -1: continue
+            x, y = positions[i]
+            if closest is None or (dist, y, x) < closest:
+                closest = (dist, y, x)
+        if closest is None:
+            return None
+        return self.game_state.map.get_cell(closest[2], closest[1])
+
+    def closest_city_tile(self, pos):
+        # same answer as find_closest_city_tile
+        if self.city_field is None:
+            return None
+        dist, i = self.city_field.lookup(pos.x, pos.y)
+        if i == -1:
+            return None
+        return self.city_tiles[i]
+
+
+# Lets check that the spatial index agrees with the linear scans from every cell of the map, for both players of the last game
+
+# In[25]:
+
+
+spatial_index = SpatialIndex(game_state.map_width, game_state.map_height)
+for player in game_state.players:
+    spatial_index.update(game_state, resource_index, player)
+    resource_tiles = find_resources(game_state)
+    for y in range(game_state.map_height):
+        for x in range(game_state.map_width):
+            pos = Position(x, y)
+            assert spatial_index.closest_resource(pos, player) is find_closest_resources(pos, player, resource_tiles)
+            assert spatial_index.closest_city_tile(pos) is find_closest_city_tile(pos, player)
+
+
+# In[26]:
+
+
+game_state = None
+resource_index = None
+spatial_index = None
+def agent(observation, configuration):
+    global game_state, resource_index, spatial_index
+
+    ### Do not edit ###
+    if observation["step"] == 0:
+        game_state = Game()
+        game_state._initialize(observation["updates"])
+        game_state._update(observation["updates"][2:])
+        game_state.id = observation.player
+    else:
+        game_state._update(observation["updates"])
+    
+    actions = []
+
+    ### AI Code goes down here! ### 
+    player = game_state.players[observation.player]
+    opponent = game_state.players[(observation.player + 1) % 2]
+    width, height = game_state.map.width, game_state.map.height
+
+    if observation["step"] == 0:
+        resource_index = ResourceIndex()
+        spatial_index = SpatialIndex(width, height)
+    resource_index.update(observation["updates"])
+    spatial_index.update(game_state, resource_index, player)
+    
+    for unit in player.units:
+        # if the unit is a worker (can mine resources) and can perform an action this turn
+        if unit.is_worker() and unit.can_act():
+            # we want to mine only if there is space left in the worker's cargo
+            if unit.get_cargo_space_left() > 0:
+                # find the closest resource if it exists to this unit
+                closest_resource_tile = spatial_index.closest_resource(unit.pos, player)
+                if closest_resource_tile is not None:
+                    # create a move action to move this unit in the direction of the closest resource tile and add to our actions list
+                    action = unit.move(unit.pos.direction_to(closest_resource_tile.pos))
+                    actions.append(action)
+            else:
+                # find the closest citytile and move the unit towards it to drop resources to a citytile to fuel the city
+                closest_city_tile = spatial_index.closest_city_tile(unit.pos)
+                if closest_city_tile is not None:
+                    # create a move action to move this unit in the direction of the closest resource tile and add to our actions list
+                    action = unit.move(unit.pos.direction_to(closest_city_tile.pos))
+                    actions.append(action)
+    
+    return actions
+
+
+# In[27]:
+
+
+env = make("lux_ai_2021", configuration={"seed": 562124210, "loglevel": 2, "annotations": True}, debug=True)
+steps = env.run([agent, "simple_agent"])
+env.render(mode="ipython", width=1200, height=800)
+
+
+# ### The game state as NumPy arrays
+# 
+# The `Game` object stores the map as a grid of `Cell` objects, so any question about the whole map ("how much fuel is around here?", "how far is every cell from a resource?") turns into nested Python loops. Below we keep a NumPy mirror of the state next to it. `ArrayGame` is a drop-in replacement for `Game` that refreshes the arrays every time `_update` runs, by reading the same update lines the `Game` object is built from.
+# 
+# The planes are indexed `[y, x]` like `game_state.map.map`, and resources are stacked in the order wood, coal, uranium.
+
+# In[28]:
+
+
+import numpy as np
+
+RESOURCE_PLANES = [Constants.RESOURCE_TYPES.WOOD, Constants.RESOURCE_TYPES.COAL, Constants.RESOURCE_TYPES.URANIUM]
+FUEL_RATES = np.array([GAME_CONSTANTS["PARAMETERS"]["RESOURCE_TO_FUEL_RATE"][r_type.upper()] for r_type in RESOURCE_PLANES])
+
+class GameArrays:
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.update([])
+
+    def update(self, updates):
+        width, height = self.width, self.height
+        self.research_points = np.zeros(2, dtype=np.int32)
+        # amount of wood, coal and uranium on every tile
+        self.resources = np.zeros((len(RESOURCE_PLANES), height, width), dtype=np.int32)
+        # team owning the city tile on every tile, -1 where there is no city tile
+        self.city_owner = np.full((height, width), -1, dtype=np.int8)
+        # index into the city arrays below for every city tile, -1 elsewhere
+        self.city_index = np.full((height, width), -1, dtype=np.int32)
+        self.road = np.zeros((height, width), dtype=np.float32)
+
+        resources, units, cities, city_tiles, roads = [], [], [], [], []
+        for update in updates:
+            if update == "D_DONE":
+                break
+            strs = update.split(" ")
+            input_identifier = strs[0]
+            if input_identifier == "rp":
+                self.research_points[int(strs[1])] = int(strs[2])
+            elif input_identifier == "r":
+                resources.append((RESOURCE_PLANES.index(strs[1]), int(strs[3]), int(strs[2]), int(float(strs[4]))))
+            elif input_identifier == "u":
+                units.append(strs)
+            elif input_identifier == "c":
+                cities.append(strs)
+            elif input_identifier == "ct":
+                city_tiles.append(strs)
+            elif input_identifier == "ccd":
+                roads.append((int(strs[2]), int(strs[1]), float(strs[3])))
+
+        if resources:
+            plane, y, x, amount = zip(*resources)
+            self.resources[plane, y, x] = amount
+
+        self.unit_ids = [strs[3] for strs in units]
+        self.unit_type = np.array([int(strs[1]) for strs in units], dtype=np.int8)
+        self.unit_team = np.array([int(strs[2]) for strs in units], dtype=np.int8)
+        # (x, y) of every unit
+        self.unit_pos = np.array([(int(strs[4]), int(strs[5])) for strs in units], dtype=np.int32).reshape(-1, 2)
+        self.unit_cooldown = np.array([float(strs[6]) for strs in units], dtype=np.float32)
+        # wood, coal and uranium carried by every unit
+        self.unit_cargo = np.array([strs[7:10] for strs in units], dtype=np.int32).reshape(-1, 3)
+
+        self.city_ids = [strs[2] for strs in cities]
+        self.city_team = np.array([int(strs[1]) for strs in cities], dtype=np.int8)
+        self.city_fuel = np.array([float(strs[3]) for strs in cities], dtype=np.float64)
+        self.city_upkeep = np.array([float(strs[4]) for strs in cities], dtype=np.float64)
+        city_lookup = {city_id: i for i, city_id in enumerate(self.city_ids)}
+        for strs in city_tiles:
+            x, y = int(strs[3]), int(strs[4])
+            self.city_owner[y, x] = int(strs[1])
+            self.city_index[y, x] = city_lookup[strs[2]]
+
+        if roads:
+            y, x, road = zip(*roads)
+            self.road[y, x] = road
+
+    def unit_plane(self, team):
+        # number of units of a team on every tile
+        plane = np.zeros((self.height, self.width), dtype=np.int32)
+        pos = self.unit_pos[self.unit_team == team]
+        np.add.at(plane, (pos[:, 1], pos[:, 0]), 1)
+        return plane
+
+
+# a Game that keeps a GameArrays mirror of itself up to date
+class ArrayGame(Game):
+    def _initialize(self, messages):
+        super()._initialize(messages)
+        self.arrays = GameArrays(self.map_width, self.map_height)
+
+    def _update(self, messages):
+        super()._update(messages)
+        self.arrays.update(messages)
+
+
+# With the arrays in place, whole-map questions become a handful of array operations. Here are a few we will lean on later
+
+# In[29]:
+
+
+# fuel value of the resources on every tile, leaving out the ones the given research points can't mine yet
+def fuel_plane(arrays, research_points):
+    mineable = np.array([
+        True,
+        research_points >= GAME_CONSTANTS["PARAMETERS"]["RESEARCH_REQUIREMENTS"]["COAL"],
+        research_points >= GAME_CONSTANTS["PARAMETERS"]["RESEARCH_REQUIREMENTS"]["URANIUM"],
+    ])
+    return np.tensordot(FUEL_RATES * mineable, arrays.resources, axes=1)
+
+# sum of a plane over the (2 * radius + 1) square around every tile, using a summed area table
+def box_sum(plane, radius):
+    height, width = plane.shape
+    table = np.zeros((height + 1, width + 1), dtype=np.float64)
+    table[1:, 1:] = plane.cumsum(axis=0).cumsum(axis=1)
+    y0 = np.clip(np.arange(height) - radius, 0, height)
+    y1 = np.clip(np.arange(height) + radius + 1, 0, height)
+    x0 = np.clip(np.arange(width) - radius, 0, width)
+    x1 = np.clip(np.arange(width) + radius + 1, 0, width)
+    return table[y1][:, x1] - table[y0][:, x1] - table[y1][:, x0] + table[y0][:, x0]
+
+# how much mineable fuel lies within radius tiles of every tile
+def resource_density(arrays, research_points, radius=2):
+    return box_sum(fuel_plane(arrays, research_points), radius)
+
+# for every city, whether its fuel lasts through a whole night at its current upkeep
+def survives_night(arrays):
+    return arrays.city_fuel >= arrays.city_upkeep * GAME_CONSTANTS["PARAMETERS"]["NIGHT_LENGTH"]
+
+# Manhattan distance from every tile to the nearest tile where mask is True (inf if there is none).
+# The distance is separable, so two sweeps along each axis are enough
+def distance_field(mask):
+    dist = np.where(mask, 0.0, np.inf)
+    for axis in (1, 0):
+        dist = np.moveaxis(dist, axis, 0)
+        for i in range(1, dist.shape[0]):
+            np.minimum(dist[i], dist[i - 1] + 1, out=dist[i])
+        for i in range(dist.shape[0] - 2, -1, -1):
+            np.minimum(dist[i], dist[i + 1] + 1, out=dist[i])
+        dist = np.moveaxis(dist, 0, axis)
+    return dist
+
+
+# In[30]:
+
+
+arrays = GameArrays(game_state.map_width, game_state.map_height)
+arrays.update(steps[-1][0]["observation"]["updates"])
+player = game_state.players[0]
+density = resource_density(arrays, player.research_points)
+y, x = np.unravel_index(density.argmax(), density.shape)
+print("Richest area around", Position(x, y), "with", density[y, x], "fuel")
+print("Cities that survive the next night:", dict(zip(arrays.city_ids, survives_night(arrays).tolist())))
+print(distance_field(arrays.resources.sum(axis=0) > 0))
+
+
+# ### Obstacle aware routing with distance fields
+# 
+# So far every unit picks a target and then walks towards it with `direction_to`, which happily walks into opponent city tiles and other units. Rather than searching for a path per unit, we can run one breadth first search per kind of target that starts from all the targets at once. The result is a distance field: for every tile, the number of moves to the nearest target going around obstacles. A unit then only has to step to the neighbouring tile with the smallest distance, so the cost per unit is a handful of lookups no matter how many units there are.
+# 
+# As obstacles we use opponent city tiles (units can never enter them) and every unit we know will still be standing where it is next turn: units that are cooling down, plus the opponent's units since we can't know where they will go. Units can always share our own city tiles, so those are never obstacles.
+
+# In[31]:
+
+
+DIRECTION_STEPS = [
+    (Constants.DIRECTIONS.NORTH, 0, -1),
+    (Constants.DIRECTIONS.EAST, 1, 0),
+    (Constants.DIRECTIONS.SOUTH, 0, 1),
+    (Constants.DIRECTIONS.WEST, -1, 0),
+]
+
+# number of moves from every tile to the nearest target tile without passing through a blocked tile, -1 where no
+# target can be reached. Each pass of the loop grows the search by one tile in all directions at once
+def bfs_distance_field(targets, blocked):
+    free = ~blocked
+    dist = np.full(targets.shape, -1, dtype=np.int32)
+    frontier = targets & free
+    dist[frontier] = 0
+    d = 0
+    while frontier.any():
+        d += 1
+        reached = np.zeros_like(frontier)
+        reached[1:] |= frontier[:-1]
+        reached[:-1] |= frontier[1:]
+        reached[:, 1:] |= frontier[:, :-1]
+        reached[:, :-1] |= frontier[:, 1:]
+        frontier = reached & free & (dist == -1)
+        dist[frontier] = d
+    return dist
+
+# tiles units of the given team can't move into next turn
+def movement_blockers(arrays, team):
+    blocked = arrays.city_owner == (team + 1) % 2
+    staying = (arrays.unit_team != team) | (arrays.unit_cooldown >= 1)
+    pos = arrays.unit_pos[staying]
+    blocked[pos[:, 1], pos[:, 0]] = True
+    blocked &= arrays.city_owner != team
+    return blocked
+
+# the direction that takes a unit at pos one step down the distance field, CENTER if it is already on a target and
+# None if no target can be reached from here. Ties are broken in the same order direction_to checks directions
+def direction_from_field(dist, pos):
+    here = dist[pos.y, pos.x]
+    if here == 0:
+        return Constants.DIRECTIONS.CENTER
+    height, width = dist.shape
+    closest_dir = None
+    closest_dist = here if here > 0 else math.inf
+    for direction, dx, dy in DIRECTION_STEPS:
+        x, y = pos.x + dx, pos.y + dy
+        if 0 <= x < width and 0 <= y < height and 0 <= dist[y, x] < closest_dist:
+            closest_dir = direction
+            closest_dist = dist[y, x]
+    return closest_dir
+
+# the two fields our workers need each turn: one towards resources we can mine and one towards our own city tiles
+def target_fields(arrays, player):
+    blocked = movement_blockers(arrays, player.team)
+    mineable = fuel_plane(arrays, player.research_points) > 0
+    resource_field = bfs_distance_field(mineable, blocked)
+    city_field = bfs_distance_field(arrays.city_owner == player.team, blocked)
+    return resource_field, city_field
+
+
+# The agent now builds the two fields once per turn and every worker just reads its direction from them. If a unit is boxed in and can't reach anything, it falls back to walking straight towards the closest target like before
+
+# In[32]:
+
+
+game_state = None
+resource_index = None
+spatial_index = None
+def agent(observation, configuration):
+    global game_state, resource_index, spatial_index
+
+    ### Do not edit ###
+    if observation["step"] == 0:
+        game_state = ArrayGame()
+        game_state._initialize(observation["updates"])
+        game_state._update(observation["updates"][2:])
+        game_state.id = observation.player
+    else:
+        game_state._update(observation["updates"])
+    
+    actions = []
+
+    ### AI Code goes down here! ### 
+    player = game_state.players[observation.player]
+    opponent = game_state.players[(observation.player + 1) % 2]
+    width, height = game_state.map.width, game_state.map.height
+
+    if observation["step"] == 0:
+        resource_index = ResourceIndex()
+        spatial_index = SpatialIndex(width, height)
+    resource_index.update(observation["updates"])
+    spatial_index.update(game_state, resource_index, player)
+    resource_field, city_field = target_fields(game_state.arrays, player)
+    
+    for unit in player.units:
+        # if the unit is a worker (can mine resources) and can perform an action this turn
+        if unit.is_worker() and unit.can_act():
+            # we want to mine only if there is space left in the worker's cargo
+            if unit.get_cargo_space_left() > 0:
+                direction = direction_from_field(resource_field, unit.pos)
+                if direction is None:
+                    closest_resource_tile = spatial_index.closest_resource(unit.pos, player)
+                    if closest_resource_tile is not None:
+                        direction = unit.pos.direction_to(closest_resource_tile.pos)
+            else:
+                # head to the closest citytile to drop resources to fuel the city
+                direction = direction_from_field(city_field, unit.pos)
+                if direction is None:
+                    closest_city_tile = spatial_index.closest_city_tile(unit.pos)
+                    if closest_city_tile is not None:
+                        direction = unit.pos.direction_to(closest_city_tile.pos)
+            if direction is not None:
+                actions.append(unit.move(direction))
+    
+    return actions
+
+
+# In[33]:
+
+
+env = make("lux_ai_2021", configuration={"seed": 562124210, "loglevel": 2, "annotations": True}, debug=True)
+steps = env.run([agent, "simple_agent"])
+env.render(mode="ipython", width=1200, height=800)
+
+
+# ### Resolving collisions before we send our moves
+# 
+# With `loglevel` 2 you will have noticed plenty of warnings about units colliding. The engine cancels every move into a tile that another unit is moving into or standing on (unless it is a city tile, where units can stack), and cancelling one move can cancel the moves of units queued up behind it. Each cancelled move is a wasted turn for that unit.
+# 
+# Instead of adding each move to the action list as soon as we decide on it, every unit now proposes a ranked list of directions, and a resolver looks at all the proposals together. It walks through the units in priority order and reserves the tile each one will occupy next turn, giving a unit its next best direction when its first choice is taken. If a unit ends up staying where it is, any unit that planned to move onto its tile is bumped to its next choice and the pass is repeated. Only the moves that survive are sent, and the resolver keeps a small report of how many conflicts it fixed.
+
+# In[34]:
+
+
+# every direction that takes a unit at pos closer to a target on the distance field, best first
+def ranked_directions_from_field(dist, pos):
+    here = dist[pos.y, pos.x]
+    if here == 0:
+        return [Constants.DIRECTIONS.CENTER]
+    height, width = dist.shape
+    ranked = []
+    for direction, dx, dy in DIRECTION_STEPS:
+        x, y = pos.x + dx, pos.y + dy
+        if 0 <= x < width and 0 <= y < height and dist[y, x] >= 0 and (here < 0 or dist[y, x] < here):
+            ranked.append((dist[y, x], len(ranked), direction))
+    return [direction for _, _, direction in sorted(ranked)]
+
+
+class MoveResolver:
+    def __init__(self, max_rounds=100):
+        self.max_rounds = max_rounds
+        self.report = {}
+
+    def resolve(self, game_state, team, proposals):
+        # proposals is a list of (unit, [directions best first]) in priority order. Returns the move actions to send
+        width, height = game_state.map_width, game_state.map_height
+        moving = {unit.id for unit, _ in proposals}
+
+        def is_city_tile(x, y):
+            return game_state.map.get_cell(x, y).citytile is not None
+
+        # tiles held next turn by units that won't move: ours that are cooling down or have nothing to do, and all of
+        # the opponent's since we can't know where they are going. Units can share city tiles so those are never held
+        held = {}
+        for player in game_state.players:
+            for unit in player.units:
+                if unit.id not in moving and not is_city_tile(unit.pos.x, unit.pos.y):
+                    held[(unit.pos.x, unit.pos.y)] = -1
+
+        options = []
+        for unit, directions in proposals:
+            unit_options = []
+            for direction in directions + [Constants.DIRECTIONS.CENTER]:
+                pos = unit.pos.translate(direction, 1)
+                if not (0 <= pos.x < width and 0 <= pos.y < height):
+                    continue
+                citytile = game_state.map.get_cell(pos.x, pos.y).citytile
+                if citytile is not None and citytile.team != team:
+                    continue
+                if direction not in [option[0] for option in unit_options]:
+                    unit_options.append((direction, (pos.x, pos.y), citytile is not None))
+                # staying put is always possible, so nothing after it is ever needed
+                if direction == Constants.DIRECTIONS.CENTER:
+                    break
+            options.append(unit_options)
+
+        choice = [0] * len(proposals)
+        rounds = 0
+        gave_up = False
+        while True:
+            rounds += 1
+            if rounds > self.max_rounds:
+                # every unit staying where it is never collides, so that is what we fall back to
+                choice = [len(unit_options) - 1 for unit_options in options]
+                gave_up = True
+                break
+            claimed = dict(held)
+            bumped = None
+            for i, unit_options in enumerate(options):
+                for k in range(choice[i], len(unit_options)):
+                    direction, pos, on_city = unit_options[k]
+                    if on_city or pos not in claimed or direction == Constants.DIRECTIONS.CENTER:
+                        break
+                choice[i] = k
+                if on_city:
+                    continue
+                if direction == Constants.DIRECTIONS.CENTER:
+                    # units left stacked on a tile when their city went dark can all stay there, so staying only
+                    # clashes with an earlier unit that planned to move onto our tile, and that unit has to give way
+                    owner = claimed.get(pos, -1)
+                    if owner >= 0 and options[owner][choice[owner]][0] != Constants.DIRECTIONS.CENTER:
+                        bumped = owner
+                        break
+                    claimed.setdefault(pos, i)
+                    continue
+                claimed[pos] = i
+            if bumped is None:
+                break
+            choice[bumped] += 1
+
+        actions = []
+        conflicts = 0
+        held_back = 0
+        for (unit, directions), unit_options, k in zip(proposals, options, choice):
+            direction = unit_options[k][0]
+            if directions and direction != directions[0]:
+                conflicts += 1
+                if direction == Constants.DIRECTIONS.CENTER:
+                    held_back += 1
+            if direction != Constants.DIRECTIONS.CENTER:
+                actions.append(unit.move(direction))
+        self.report = {"proposed": len(proposals), "conflicts": conflicts, "held_back": held_back, "rounds": rounds, "gave_up": gave_up}
+        return actions
+
+
+# Units can end up stacked on a tile that isn't a city tile when their city goes dark. Here two workers with nothing to
+# do share a tile, another worker shares one with a unit that is cooling down, and a third worker wants to move onto
+# the first tile. Nobody may move onto a stacked tile, and the unit further away still gets its move
+stacked_game = Game()
+stacked_game._initialize(["0", "12 12"])
+stacked_game._update(["rp 0 0", "rp 1 0",
+                      "u 0 0 u_1 5 5 0 0 0 0", "u 0 0 u_2 5 5 0 0 0 0", "u 0 0 u_3 6 5 0 0 0 0",
+                      "u 0 0 u_4 2 2 2 0 0 0", "u 0 0 u_5 2 2 0 0 0 0", "u 0 0 u_6 8 8 0 0 0 0", "D_DONE"])
+stacked_units = {unit.id: unit for unit in stacked_game.players[0].units}
+stacked_proposals = [(stacked_units["u_3"], [Constants.DIRECTIONS.WEST]), (stacked_units["u_1"], []), (stacked_units["u_2"], []),
+                     (stacked_units["u_5"], []), (stacked_units["u_6"], [Constants.DIRECTIONS.NORTH])]
+stacked_resolver = MoveResolver()
+stacked_actions = stacked_resolver.resolve(stacked_game, 0, stacked_proposals)
+assert stacked_actions == ["m u_6 n"], stacked_actions
+print(stacked_resolver.report)
+
+
+# The agent now only collects proposals in the unit loop and hands them all to the resolver at the end
+
+# In[35]:
+
+
+game_state = None
+resource_index = None
+spatial_index = None
+move_resolver = None
+def agent(observation, configuration):
+    global game_state, resource_index, spatial_index, move_resolver
+
+    ### Do not edit ###
+    if observation["step"] == 0:
+        game_state = ArrayGame()
+        game_state._initialize(observation["updates"])
+        game_state._update(observation["updates"][2:])
+        game_state.id = observation.player
+    else:
+        game_state._update(observation["updates"])
+    
+    actions = []
+
+    ### AI Code goes down here! ### 
+    player = game_state.players[observation.player]
+    opponent = game_state.players[(observation.player + 1) % 2]
+    width, height = game_state.map.width, game_state.map.height
+
+    if observation["step"] == 0:
+        resource_index = ResourceIndex()
+        spatial_index = SpatialIndex(width, height)
+        move_resolver = MoveResolver()
+    resource_index.update(observation["updates"])
+    spatial_index.update(game_state, resource_index, player)
+    resource_field, city_field = target_fields(game_state.arrays, player)
+    
+    proposals = []
+    for unit in player.units:
+        # if the unit is a worker (can mine resources) and can perform an action this turn
+        if unit.is_worker() and unit.can_act():
+            # we want to mine only if there is space left in the worker's cargo
+            if unit.get_cargo_space_left() > 0:
+                directions = ranked_directions_from_field(resource_field, unit.pos)
+                if not directions:
+                    closest_resource_tile = spatial_index.closest_resource(unit.pos, player)
+                    if closest_resource_tile is not None:
+                        directions = [unit.pos.direction_to(closest_resource_tile.pos)]
+            else:
+                # head to the closest citytile to drop resources to fuel the city
+                directions = ranked_directions_from_field(city_field, unit.pos)
+                if not directions:
+                    closest_city_tile = spatial_index.closest_city_tile(unit.pos)
+                    if closest_city_tile is not None:
+                        directions = [unit.pos.direction_to(closest_city_tile.pos)]
+            proposals.append((unit, directions))
+
+    actions.extend(move_resolver.resolve(game_state, player.team, proposals))
+    if move_resolver.report["conflicts"] > 0:
+        actions.append(annotate.sidetext("resolved {} move conflicts".format(move_resolver.report["conflicts"])))
+    
+    return actions
+
+
+# In[36]:
+
+
+env = make("lux_ai_2021", configuration={"seed": 562124210, "loglevel": 2, "annotations": True}, debug=True)
+steps = env.run([agent, "simple_agent"])
+env.render(mode="ipython", width=1200, height=800)
+
+
+# ## Evaluating Changes in Bulk
+# 
+# Watching a single replay is a good way to see what the agent does, but it won't tell you whether a change made the agent better. For that we need to play a lot of games on different seeds, and each `env.run` above also renders the game and captures debug output, which makes it slow. The runner below plays every (opponent, seed) pair headless and spreads the matches over a pool of processes. Each process runs its matches one after the other, so the global `game_state` of our agent is never shared between two games.
+# 
+# For every match it records the result, the number of city tiles each side ended with and how long our agent took per turn.
+
+# In[37]:
+
+
+import time
+import multiprocessing
+import pandas as pd
+
+# wraps an agent function and records how long each of its turns takes
+class TimedAgent:
+    def __init__(self, agent):
+        self.agent = agent
+        self.latencies = []
+
+    def __call__(self, observation, configuration):
+        start = time.perf_counter()
+        actions = self.agent(observation, configuration)
+        self.latencies.append(time.perf_counter() - start)
+        return actions
+
+# number of city tiles each team owns in a list of update lines
+def count_city_tiles(updates):
+    counts = [0, 0]
+    for update in updates:
+        if update.startswith("ct "):
+            counts[int(update.split(" ")[1])] += 1
+    return counts
+
+def play_match(job):
+    agent, opponent, seed = job
+    timed_agent = TimedAgent(agent)
+    env = make("lux_ai_2021", configuration={"seed": seed, "loglevel": 0, "annotations": False}, debug=False)
+    steps = env.run([timed_agent, opponent])
+    ours, theirs = steps[-1]
+    reward = ours["reward"] if ours["reward"] is not None else -1
+    opponent_reward = theirs["reward"] if theirs["reward"] is not None else -1
+    city_tiles = count_city_tiles(ours["observation"]["updates"])
+    latencies = np.array(timed_agent.latencies) if timed_agent.latencies else np.zeros(1)
+    return {
+        "opponent": opponent if isinstance(opponent, str) else opponent.__name__,
+        "seed": seed,
+        "result": "win" if reward > opponent_reward else "loss" if reward < opponent_reward else "draw",
+        "status": ours["status"],
+        "turns": len(steps) - 1,
+        "city_tiles": city_tiles[0],
+        "opponent_city_tiles": city_tiles[1],
+        "mean_latency": latencies.mean(),
+        "p95_latency": np.percentile(latencies, 95),
+        "max_latency": latencies.max(),
+    }
+
+# the lux environment talks to a single Node.js engine process per Python process. A forked worker would inherit the
+# notebook's engine and share it with the notebook, so we make each worker start its own
+def start_worker():
+    from kaggle_environments.envs.lux_ai_2021 import lux_ai_2021
+    lux_ai_2021.dimension_process = None
+
+# the matches run_matches is playing. Workers are forked after it is set, so they find every agent here and only get
+# sent the index of their match. Sending the agents themselves would pickle functions by name, which only works for the
+# function that is called agent right now and not for greedy_agent or a wrapped agent
+match_jobs = []
+
+def play_match_job(i):
+    return play_match(match_jobs[i])
+
+# plays our agent against every opponent on every seed, processes defaults to one per CPU core.
+# We fork the worker processes so that agent functions defined in this notebook are available to them
+def run_matches(agent, opponents, seeds, processes=None):
+    global match_jobs
+    match_jobs = [(agent, opponent, seed) for opponent in opponents for seed in seeds]
+    with multiprocessing.get_context("fork").Pool(processes, initializer=start_worker) as pool:
+        rows = list(pool.imap_unordered(play_match_job, range(len(match_jobs))))
+    return pd.DataFrame(rows).sort_values(["opponent", "seed"]).reset_index(drop=True)
+
+
+# Lets play a batch of games against the simple agent and the random agent and summarize them per opponent
+
+# In[38]:
+
+
+results = run_matches(agent, ["simple_agent", "random_agent"], range(16))
+print(results.groupby("opponent").agg(
+    games=("seed", "count"),
+    win_rate=("result", lambda result: (result == "win").mean()),
+    city_tiles=("city_tiles", "mean"),
+    mean_latency=("mean_latency", "mean"),
+    max_latency=("max_latency", "max"),
+))
+
+
+# ## Where Does the Time Go?
+# 
+# Kaggle gives the agent 3 seconds per turn plus a small pool of overage time for the whole match, and running out means forfeiting. The runner above tells us how long whole turns take, but not which part of the agent is responsible. The profiler below wraps the agent and its helpers with timers. It only swaps in the timed versions while profiling is switched on, so when it is off the agent runs the original functions with no overhead at all.
+# 
+# It keeps every call's wall time so it can report call counts and tail percentiles per function, remembers how long each turn took in total, and can write the time spent in each call stack in the folded format that [flamegraph.pl](https://github.com/brendangregg/FlameGraph) and [speedscope](https://www.speedscope.app/) read.
+
+# In[39]:
+
+
+import functools
+from contextlib import contextmanager
+
+# functions looked up by name in the notebook's globals and methods looked up on their classes
+PROFILED_FUNCTIONS = ["agent", "find_resources", "find_closest_resources", "find_closest_city_tile", "target_fields"]
+PROFILED_METHODS = [
+    (Game, "_update"),
+    (GameArrays, "update"),
+    (ResourceIndex, "update"),
+    (SpatialIndex, "update"),
+    (SpatialIndex, "closest_resource"),
+    (SpatialIndex, "closest_city_tile"),
+    (MoveResolver, "resolve"),
+]
+
+class TurnProfiler:
+    def __init__(self):
+        self._originals = []
+        self.reset()
+
+    def reset(self):
+        self.durations = {}
+        self.turns = []
+        self.folded = {}
+        self._turn = {}
+        self._stack = []
+
+    def _wrap(self, name, fn):
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            # each stack entry is [name, time spent in the calls it made], so we can tell its own time apart
+            self._stack.append([name, 0.0])
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                stack = ";".join(entry[0] for entry in self._stack)
+                _, children = self._stack.pop()
+                self.folded[stack] = self.folded.get(stack, 0.0) + elapsed - children
+                self.durations.setdefault(name, []).append(elapsed)
+                self._turn[name] = self._turn.get(name, 0.0) + elapsed
+                if self._stack:
+                    self._stack[-1][1] += elapsed
+                else:
+                    # the outermost call is the agent itself, so it finishing means the turn is over
+                    self.turns.append(self._turn)
+                    self._turn = {}
+        if name == "agent":
+            # kaggle-environments only passes an agent as many arguments as its signature declares
+            @functools.wraps(fn)
+            def timed_agent(observation, configuration):
+                return timed(observation, configuration)
+            return timed_agent
+        return timed
+
+    def enable(self, namespace):
+        if self._originals:
+            return
+        for name in PROFILED_FUNCTIONS:
+            if name in namespace:
+                self._originals.append((namespace, name, namespace[name]))
+                namespace[name] = self._wrap(name, namespace[name])
+        for cls, name in PROFILED_METHODS:
+            method = cls.__dict__[name]
+            self._originals.append((cls, name, method))
+            setattr(cls, name, self._wrap("{}.{}".format(cls.__name__, name), method))
+
+    def disable(self):
+        for owner, name, original in reversed(self._originals):
+            if isinstance(owner, dict):
+                owner[name] = original
+            else:
+                setattr(owner, name, original)
+        self._originals = []
+
+    @contextmanager
+    def profiling(self, namespace):
+        self.enable(namespace)
+        try:
+            yield self
+        finally:
+            self.disable()
+
+    def report(self):
+        # one row per profiled function, times in milliseconds
+        rows = []
+        for name, durations in self.durations.items():
+            durations = np.array(durations) * 1000
+            rows.append({
+                "name": name,
+                "calls": len(durations),
+                "calls_per_turn": len(durations) / max(len(self.turns), 1),
+                "total_ms": durations.sum(),
+                "mean_ms": durations.mean(),
+                "p50_ms": np.percentile(durations, 50),
+                "p95_ms": np.percentile(durations, 95),
+                "p99_ms": np.percentile(durations, 99),
+                "max_ms": durations.max(),
+            })
+        return pd.DataFrame(rows).sort_values("total_ms", ascending=False).reset_index(drop=True)
+
+    def turn_times(self):
+        # milliseconds spent in each function on every turn
+        return pd.DataFrame(self.turns).fillna(0) * 1000
+
+    def dump_folded(self, path):
+        # one "outer;inner;innermost <microseconds>" line per call stack
+        with open(path, "w") as f:
+            for stack, seconds in sorted(self.folded.items()):
+                f.write("{} {}\n".format(stack, int(seconds * 1e6)))
+
+
+# Lets profile a match. The per-turn table makes it easy to spot whether the late game is creeping towards the 3 second limit
+
+# In[40]:
+
+
+profiler = TurnProfiler()
+env = make("lux_ai_2021", configuration={"seed": 562124210, "loglevel": 0}, debug=False)
+with profiler.profiling(globals()):
+    steps = env.run([agent, "simple_agent"])
+print(profiler.report())
+turn_times = profiler.turn_times()["agent"]
+print("slowest turns (ms):")
+print(turn_times.nlargest(5))
+print("share of the 3s budget used by the slowest turn: {:.1%}".format(turn_times.max() / 1000 / env.configuration.actTimeout))
+profiler.dump_folded("agent.folded")
+
+
+# ### Staying inside the time budget
+# 
+# As the number of units grows so does the work per turn, and nothing stops a turn from running past the time limit. Each turn the agent gets `actTimeout` seconds, and anything over that is taken from `remainingOverageTime`, a pool that has to last the whole match. The budget below works out a deadline for the current turn from both: the per-turn timeout plus a fair share of the overage left for the remaining turns, with a safety margin for the time spent outside our code.
+# 
+# It also remembers how long each expensive stage took on previous turns, so the agent can check before starting a stage whether it is likely to finish in time. When it isn't, the agent falls back to a cheaper version: units use greedy moves towards their closest target instead of the distance fields, and if even the move resolver doesn't fit, the moves are sent unresolved. Units are processed most important first, so when we run out of time it is the least important ones that get the cheap treatment. We'd rather lose a little plan quality than forfeit a match on a timeout.
+
+# In[41]:
+
+
+class TurnBudget:
+    def __init__(self, safety=0.5, smoothing=0.2):
+        # fraction of the time available that we allow ourselves to use
+        self.safety = safety
+        self.smoothing = smoothing
+        # moving average of how long each stage took, in seconds
+        self.stage_costs = {}
+        self.degraded = []
+        self.start = self.deadline = time.perf_counter()
+
+    def start_turn(self, observation, configuration):
+        self.start = time.perf_counter()
+        turns_left = max(configuration["episodeSteps"] - observation["step"], 1)
+        available = configuration["actTimeout"] + max(observation["remainingOverageTime"], 0) / turns_left
+        self.deadline = self.start + available * self.safety
+        self.degraded = []
+
+    def remaining(self):
+        return self.deadline - time.perf_counter()
+
+    def expired(self):
+        return time.perf_counter() >= self.deadline
+
+    def can_afford(self, stage):
+        # stages we haven't timed yet are always attempted once
+        if self.remaining() > 2 * self.stage_costs.get(stage, 0.0):
+            return True
+        self.degraded.append(stage)
+        return False
+
+    @contextmanager
+    def measure(self, stage):
+        start = time.perf_counter()
+        yield
+        elapsed = time.perf_counter() - start
+        if stage in self.stage_costs:
+            elapsed = (1 - self.smoothing) * self.stage_costs[stage] + self.smoothing * elapsed
+        self.stage_costs[stage] = elapsed
+
+
+# units carrying fuel to a city come first since cities go dark without it, then workers that are closest to full
+def unit_priority(unit):
+    return (unit.get_cargo_space_left() > 0, unit.get_cargo_space_left())
+
+
+# The agent now starts each turn by setting up the budget, and checks it before building the distance fields, before each unit and before resolving moves
+
+# In[42]:
+
+
+game_state = None
+resource_index = None
+spatial_index = None
+move_resolver = None
+turn_budget = None
+def agent(observation, configuration):
+    global game_state, resource_index, spatial_index, move_resolver, turn_budget
+
+    if observation["step"] == 0:
+        turn_budget = TurnBudget()
+    turn_budget.start_turn(observation, configuration)
+
+    ### Do not edit ###
+    if observation["step"] == 0:
+        game_state = ArrayGame()
+        game_state._initialize(observation["updates"])
+        game_state._update(observation["updates"][2:])
+        game_state.id = observation.player
+    else:
+        game_state._update(observation["updates"])
+    
+    actions = []
+
+    ### AI Code goes down here! ### 
+    player = game_state.players[observation.player]
+    opponent = game_state.players[(observation.player + 1) % 2]
+    width, height = game_state.map.width, game_state.map.height
+
+    if observation["step"] == 0:
+        resource_index = ResourceIndex()
+        spatial_index = SpatialIndex(width, height)
+        move_resolver = MoveResolver()
+    resource_index.update(observation["updates"])
+    spatial_index.update(game_state, resource_index, player)
+
+    resource_field, city_field = None, None
+    if turn_budget.can_afford("target_fields"):
+        with turn_budget.measure("target_fields"):
+            resource_field, city_field = target_fields(game_state.arrays, player)
+    
+    proposals = []
+    for unit in sorted(player.units, key=unit_priority):
+        # if the unit is a worker (can mine resources) and can perform an action this turn
+        if unit.is_worker() and unit.can_act():
+            # once we are out of time, the remaining units just walk straight towards their closest target
+            use_fields = resource_field is not None and not turn_budget.expired()
+            # we want to mine only if there is space left in the worker's cargo
+            if unit.get_cargo_space_left() > 0:
+                directions = ranked_directions_from_field(resource_field, unit.pos) if use_fields else []
+                if not directions:
+                    closest_resource_tile = spatial_index.closest_resource(unit.pos, player)
+                    if closest_resource_tile is not None:
+                        directions = [unit.pos.direction_to(closest_resource_tile.pos)]
+            else:
+                # head to the closest citytile to drop resources to fuel the city
+                directions = ranked_directions_from_field(city_field, unit.pos) if use_fields else []
+                if not directions:
+                    closest_city_tile = spatial_index.closest_city_tile(unit.pos)
+                    if closest_city_tile is not None:
+                        directions = [unit.pos.direction_to(closest_city_tile.pos)]
+            proposals.append((unit, directions))
+
+    if turn_budget.can_afford("resolve_moves"):
+        with turn_budget.measure("resolve_moves"):
+            actions.extend(move_resolver.resolve(game_state, player.team, proposals))
+        if move_resolver.report["conflicts"] > 0:
+            actions.append(annotate.sidetext("resolved {} move conflicts".format(move_resolver.report["conflicts"])))
+    else:
+        for unit, directions in proposals:
+            if directions and directions[0] != Constants.DIRECTIONS.CENTER:
+                actions.append(unit.move(directions[0]))
+    if turn_budget.degraded:
+        actions.append(annotate.sidetext("out of time for: {}".format(", ".join(turn_budget.degraded))))
+    
+    return actions
+
+
+# In[43]:
+
+
+results = run_matches(agent, ["simple_agent"], range(16))
+print(results[["seed", "result", "city_tiles", "mean_latency", "max_latency"]])
+
+
+# ## Smaller Replays
+# 
+# `json.dump(env.toJSON())` from earlier saves every agent's full observation on every step, which adds up quickly when archiving thousands of self-play games. Most of each turn's observation is the same as the turn before: every resource tile, unit and city is listed again even if nothing happened to it. The replay format below only stores what changed.
+# 
+# A replay file is a short header followed by one frame per turn, and each frame is compressed on its own and prefixed with its length. This means a game can be written turn by turn while it is being played, and a reader can jump over frames without decompressing them. Most frames store the turn's update lines as a list of references to runs of lines from the previous turn plus the lines that are new. Every `keyframe_every` turns a frame stores the full list instead, so reading a turn only needs the frames since the last keyframe. Each frame also stores both agents' actions, rewards and statuses.
+
+# In[44]:
+
+
+import json
+import struct
+import zlib
+
+REPLAY_MAGIC = b"LUXR1\n"
+
+# describes lines as references to [start, count] runs of previous plus any lines that are new
+def encode_lines(previous, lines):
+    index = {line: i for i, line in enumerate(previous)}
+    tokens = []
+    for line in lines:
+        i = index.get(line)
+        if i is None:
+            tokens.append(line)
+        elif tokens and isinstance(tokens[-1], list) and sum(tokens[-1]) == i:
+            tokens[-1][1] += 1
+        else:
+            tokens.append([i, 1])
+    return tokens
+
+def decode_lines(previous, tokens):
+    lines = []
+    for token in tokens:
+        if isinstance(token, str):
+            lines.append(token)
+        else:
+            lines.extend(previous[token[0]:token[0] + token[1]])
+    return lines
+
+
+class ReplayWriter:
+    def __init__(self, path, header=None, keyframe_every=50):
+        self.file = open(path, "wb")
+        self.keyframe_every = keyframe_every
+        self.turns = 0
+        self.previous = None
+        self.file.write(REPLAY_MAGIC)
+        self._write_frame(dict(header or {}, keyframe_every=keyframe_every))
+
+    def _write_frame(self, record):
+        data = zlib.compress(json.dumps(record, separators=(",", ":")).encode())
+        self.file.write(struct.pack("<I", len(data)))
+        self.file.write(data)
+
+    def write_turn(self, agent_states):
+        # agent_states is one entry of env.steps, player 0's observation holds the update lines for the turn
+        lines = list(agent_states[0]["observation"]["updates"])
+        record = {
+            "step": agent_states[0]["observation"]["step"],
+            "actions": [state["action"] for state in agent_states],
+            "rewards": [state["reward"] for state in agent_states],
+            "status": [state["status"] for state in agent_states],
+        }
+        if self.previous is None or self.turns % self.keyframe_every == 0:
+            record["lines"] = lines
+        else:
+            record["delta"] = encode_lines(self.previous, lines)
+        self._write_frame(record)
+        self.file.flush()
+        self.previous = lines
+        self.turns += 1
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ReplayReader:
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        if self.file.read(len(REPLAY_MAGIC)) != REPLAY_MAGIC:
+            raise ValueError("{} is not a replay file".format(path))
+        end = self.file.seek(0, 2)
+        self.file.seek(len(REPLAY_MAGIC))
+        # only the frame lengths are read here, the frames themselves are decompressed on demand
+        self.offsets = []
+        while True:
+            size = self.file.read(4)
+            if len(size) < 4:
+                break
+            (length,) = struct.unpack("<I", size)
+            offset = self.file.tell()
+            if offset + length > end:
+                # the last frame of a replay that is still being written
+                break
+            self.offsets.append((offset, length))
+            self.file.seek(length, 1)
+        self.header = self._read_frame(0)
+        self._cache = (None, None)
+
+    def _read_frame(self, i):
+        offset, length = self.offsets[i]
+        self.file.seek(offset)
+        return json.loads(zlib.decompress(self.file.read(length)))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def turn(self, t):
+        # the record of turn t with its full list of update lines
+        if not 0 <= t < len(self):
+            raise IndexError(t)
+        # start from the last keyframe, or from the turn we read last if that is closer
+        keyframe = t - t % self.header["keyframe_every"]
+        cached_turn, lines = self._cache
+        if cached_turn is None or not keyframe <= cached_turn <= t:
+            cached_turn, lines = keyframe - 1, None
+        record = None
+        for i in range(cached_turn + 1, t + 1):
+            record = self._read_frame(i + 1)
+            lines = record.pop("lines") if "lines" in record else decode_lines(lines, record.pop("delta"))
+        if record is None:
+            record = self._read_frame(t + 1)
+            record.pop("lines", None)
+            record.pop("delta", None)
+        record["lines"] = lines
+        self._cache = (t, lines)
+        return record
+
+    def close(self):
+        self.file.close()
+
+
+# plays a match and streams it to a replay file as it goes. Our agent plays as player 0
+def record_match(agent, opponent, seed, path, keyframe_every=50):
+    env = make("lux_ai_2021", configuration={"seed": seed, "loglevel": 0, "annotations": False}, debug=False)
+    trainer = env.train([None, opponent])
+    observation = trainer.reset()
+    header = {"seed": seed, "opponent": opponent if isinstance(opponent, str) else opponent.__name__}
+    with ReplayWriter(path, header, keyframe_every) as writer:
+        writer.write_turn(env.steps[-1])
+        done = False
+        while not done:
+            observation, reward, done, info = trainer.step(agent(observation, env.configuration))
+            writer.write_turn(env.steps[-1])
+    return env
+
+# converts an episode that was already played, for example to shrink an archive of env.toJSON() replays
+def write_replay(steps, path, header=None, keyframe_every=50):
+    with ReplayWriter(path, header, keyframe_every) as writer:
+        for agent_states in steps:
+            writer.write_turn(agent_states)
+
+
+# Lets record a game and compare it to the JSON dump of the same game, both in size and in the time it takes to write
+
+# In[45]:
+
+
+import os
+
+start = time.perf_counter()
+env = record_match(agent, "simple_agent", 562124210, "replay.luxr")
+record_time = time.perf_counter() - start
+
+start = time.perf_counter()
+with open("replay.json", "w") as f:
+    json.dump(env.toJSON(), f)
+json_time = time.perf_counter() - start
+start = time.perf_counter()
+write_replay(env.steps, "replay_converted.luxr")
+write_time = time.perf_counter() - start
+
+print("json: {} bytes in {:.3f}s".format(os.path.getsize("replay.json"), json_time))
+print("luxr: {} bytes in {:.3f}s (recording the whole match took {:.1f}s)".format(os.path.getsize("replay_converted.luxr"), write_time, record_time))
+
+replay = ReplayReader("replay.luxr")
+assert replay.turn(200)["lines"] == env.steps[200][0]["observation"]["updates"]
+print(len(replay), "turns,", "turn 200 actions:", replay.turn(200)["actions"])
+
+
+# ## Training Data From Replays
+# 
+# Archived replays are also training data for imitation learning or RL, but turning replay files into tensors means parsing every file again on every epoch. Instead we convert them once. Every turn of every replay is turned into feature planes built from the same `GameArrays` the agent uses, seen from the point of view of each player, together with the actions that player took in response. The planes are written one after the other into flat binary files, which are then opened as memory maps: picking samples is just slicing, and only the pages that are actually read are loaded from disk.
+# 
+# Maps are padded to 32x32 so that games of every size fit in the same arrays, and an `on_map` plane marks the real tiles. The converter reads both `env.toJSON()` replays and the `.luxr` files from above.
+
+# In[46]:
+
+
+import os
+
+MAX_MAP_SIZE = 32
+FEATURE_PLANES = ["wood", "coal", "uranium", "own_city", "opponent_city", "road", "own_units", "opponent_units", "own_cargo", "on_map"]
+SCALAR_FEATURES = ["step", "own_research_points", "opponent_research_points", "is_night"]
+UNIT_ACTIONS = ["none", "m n", "m e", "m s", "m w", "m c", "bcity", "p", "t"]
+CITY_ACTIONS = ["none", "r", "bw", "bc"]
+
+# the GameArrays of a turn as seen by team, as a [len(FEATURE_PLANES), size, size] stack of planes
+def state_planes(arrays, team, size=MAX_MAP_SIZE):
+    planes = np.zeros((len(FEATURE_PLANES), size, size), dtype=np.float32)
+    height, width = arrays.height, arrays.width
+    planes[0:3, :height, :width] = arrays.resources
+    planes[3, :height, :width] = arrays.city_owner == team
+    planes[4, :height, :width] = arrays.city_owner == (team + 1) % 2
+    planes[5, :height, :width] = arrays.road
+    planes[6, :height, :width] = arrays.unit_plane(team)
+    planes[7, :height, :width] = arrays.unit_plane((team + 1) % 2)
+    own = arrays.unit_team == team
+    np.add.at(planes[8], (arrays.unit_pos[own, 1], arrays.unit_pos[own, 0]), arrays.unit_cargo[own].sum(axis=1))
+    planes[9, :height, :width] = 1
+    return planes
+
+def state_scalars(arrays, team, step):
+    day = GAME_CONSTANTS["PARAMETERS"]["DAY_LENGTH"]
+    cycle = day + GAME_CONSTANTS["PARAMETERS"]["NIGHT_LENGTH"]
+    return np.array([step, arrays.research_points[team], arrays.research_points[(team + 1) % 2], step % cycle >= day])
+
+# the actions of one player as two planes of indices into UNIT_ACTIONS and CITY_ACTIONS, placed on the tile of the unit
+# or city tile that acts. When several units on a city tile act, the last one listed wins
+def action_planes(arrays, actions, size=MAX_MAP_SIZE):
+    unit_actions = np.zeros((size, size), dtype=np.int8)
+    city_actions = np.zeros((size, size), dtype=np.int8)
+    unit_pos = dict(zip(arrays.unit_ids, arrays.unit_pos))
+    for action in actions or []:
+        strs = action.split(" ")
+        if strs[0] in ("m", "bcity", "p", "t") and strs[1] in unit_pos:
+            x, y = unit_pos[strs[1]]
+            unit_actions[y, x] = UNIT_ACTIONS.index("m " + strs[2] if strs[0] == "m" else strs[0])
+        elif strs[0] in ("r", "bw", "bc"):
+            city_actions[int(strs[2]), int(strs[1])] = CITY_ACTIONS.index(strs[0])
+    return unit_actions, city_actions
+
+# yields (update lines, [player 0 actions, player 1 actions]) for every turn of a replay, where the actions are the
+# ones the players sent in response to that turn
+def replay_turns(path):
+    if path.endswith(".luxr"):
+        replay = ReplayReader(path)
+        turns = [replay.turn(t) for t in range(len(replay))]
+        replay.close()
+        lines = [turn["lines"] for turn in turns]
+        actions = [turn["actions"] for turn in turns]
+    else:
+        with open(path) as f:
+            steps = json.load(f)["steps"]
+        lines = [agent_states[0]["observation"]["updates"] for agent_states in steps]
+        actions = [[state["action"] for state in agent_states] for agent_states in steps]
+    for t in range(len(lines) - 1):
+        yield lines[t], actions[t + 1]
+
+# converts replay files into memory mappable arrays in directory, one sample per turn per player
+def convert_replays(paths, directory):
+    os.makedirs(directory, exist_ok=True)
+    files = {name: open(os.path.join(directory, name + ".bin"), "wb") for name in ["features", "scalars", "unit_actions", "city_actions"]}
+    episodes = []
+    samples = 0
+    for episode, path in enumerate(paths):
+        turns = list(replay_turns(path))
+        width, height = map(int, turns[0][0][1].split(" "))
+        arrays = GameArrays(width, height)
+        for team in (0, 1):
+            episodes.append((episode, team, samples, len(turns), width, height))
+            for step, (lines, actions) in enumerate(turns):
+                arrays.update(lines)
+                unit_actions, city_actions = action_planes(arrays, actions[team])
+                files["features"].write(state_planes(arrays, team).astype(np.float16).tobytes())
+                files["scalars"].write(state_scalars(arrays, team, step).astype(np.int16).tobytes())
+                files["unit_actions"].write(unit_actions.tobytes())
+                files["city_actions"].write(city_actions.tobytes())
+            samples += len(turns)
+    for f in files.values():
+        f.close()
+    np.save(os.path.join(directory, "episodes.npy"), np.array(episodes, dtype=np.int64).reshape(-1, 6))
+    with open(os.path.join(directory, "meta.json"), "w") as f:
+        json.dump({"samples": samples, "size": MAX_MAP_SIZE, "paths": list(paths), "feature_planes": FEATURE_PLANES,
+                   "scalar_features": SCALAR_FEATURES, "unit_actions": UNIT_ACTIONS, "city_actions": CITY_ACTIONS}, f)
+
+
+class ReplayDataset:
+    def __init__(self, directory):
+        with open(os.path.join(directory, "meta.json")) as f:
+            self.meta = json.load(f)
+        n, size = self.meta["samples"], self.meta["size"]
+        def open_array(name, dtype, shape):
+            return np.memmap(os.path.join(directory, name + ".bin"), dtype=dtype, mode="r", shape=(n,) + shape)
+        self.features = open_array("features", np.float16, (len(self.meta["feature_planes"]), size, size))
+        self.scalars = open_array("scalars", np.int16, (len(self.meta["scalar_features"]),))
+        self.unit_actions = open_array("unit_actions", np.int8, (size, size))
+        self.city_actions = open_array("city_actions", np.int8, (size, size))
+        # one row per episode and team: episode, team, first sample, number of samples, width, height
+        self.episodes = np.load(os.path.join(directory, "episodes.npy"))
+        self.rng = np.random.default_rng()
+
+    def __len__(self):
+        return self.meta["samples"]
+
+    def __getitem__(self, i):
+        # views into the memory maps, nothing is copied until the arrays are used
+        return self.features[i], self.scalars[i], self.unit_actions[i], self.city_actions[i]
+
+    def episode(self, episode, team):
+        row = self.episodes[(self.episodes[:, 0] == episode) & (self.episodes[:, 1] == team)][0]
+        return self[row[2]:row[2] + row[3]]
+
+    def sample(self, batch_size, rng=None):
+        # rng is a numpy Generator. Its choice draws batch_size distinct indices directly, where the legacy np.random
+        # shuffles every index in the dataset for each batch. Sorted indices keep the reads moving forward through the files
+        rng = self.rng if rng is None else rng
+        return self[np.sort(rng.choice(len(self), batch_size, replace=False))]
+
+
+# Lets convert the replays we saved above and draw a batch
+
+# In[47]:
+
+
+convert_replays(["replay.json", "replay.luxr"], "replay_dataset")
+dataset = ReplayDataset("replay_dataset")
+features, scalars, unit_actions, city_actions = dataset.sample(64)
+print(len(dataset), "samples,", features.shape, features.dtype)
+print("unit actions in the batch:", {UNIT_ACTIONS[i]: int(n) for i, n in zip(*np.unique(unit_actions, return_counts=True))})
+
+
+# ## A Python Simulator for Fast Rollouts
+# 
+# Every `env.run` goes through `kaggle_environments`, which talks to the Node.js Lux engine over a pipe and serializes the whole state to JSON and back on every step. That is fine for watching games, but for self-play rollouts the communication costs far more than the game logic itself. Below is a re-implementation of the game rules in Python and NumPy that runs in the same process.
+# 
+# It follows the engine step by step: actions are validated the way the engine does it, moves are resolved with the same collision rules, then city tiles and units act, workers mine (uranium first, then coal, then wood, splitting a tile evenly between workers), units drop resources off at cities, cities and units burn fuel at night, depleted tiles disappear, forests regrow and cooldowns tick down. The engine doesn't generate maps in Python, so a simulated game starts from the step 0 observation of a real game. `updates()` produces the same update lines the engine sends, which means our agent can play in the simulator unchanged, and lets us check the simulator against the engine line by line.
+# 
+# Note that the engine uses a few parameter values that differ from the `game_constants.json` shipped with the Python kit, so the simulator keeps its own copy.
+
+# In[48]:
+
+
+import copy
+
+# the parameters of the Node.js engine, which differ from lux/game_constants.json for city upkeep, forest growth and roads
+SIM_PARAMETERS = copy.deepcopy(GAME_CONSTANTS["PARAMETERS"])
+SIM_PARAMETERS["LIGHT_UPKEEP"]["CITY"] = 23
+SIM_PARAMETERS["WOOD_GROWTH_RATE"] = 1.025
+SIM_PARAMETERS["CART_ROAD_DEVELOPMENT_RATE"] = 0.75
+# the engine mines uranium first and coal before wood
+MINING_ORDER = [Constants.RESOURCE_TYPES.URANIUM, Constants.RESOURCE_TYPES.COAL, Constants.RESOURCE_TYPES.WOOD]
+ALL_DIRECTIONS = [Constants.DIRECTIONS.NORTH, Constants.DIRECTIONS.EAST, Constants.DIRECTIONS.SOUTH, Constants.DIRECTIONS.WEST, Constants.DIRECTIONS.CENTER]
+DIRECTION_DELTAS = {direction: (dx, dy) for direction, dx, dy in DIRECTION_STEPS}
+DIRECTION_DELTAS[Constants.DIRECTIONS.CENTER] = (0, 0)
+
+# formats a number the way JavaScript prints it, so 2.0 becomes "2" but 0.25 stays "0.25"
+def js_number(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class SimUnit:
+    def __init__(self, team, u_type, unit_id, x, y, cooldown=0.0, wood=0, coal=0, uranium=0):
+        self.team = team
+        self.type = u_type
+        self.id = unit_id
+        self.x = x
+        self.y = y
+        self.cooldown = cooldown
+        self.cargo = {Constants.RESOURCE_TYPES.WOOD: wood, Constants.RESOURCE_TYPES.COAL: coal, Constants.RESOURCE_TYPES.URANIUM: uranium}
+
+    def is_worker(self):
+        return self.type == Constants.UNIT_TYPES.WORKER
+
+    def cargo_space_left(self):
+        capacity = SIM_PARAMETERS["RESOURCE_CAPACITY"]["WORKER" if self.is_worker() else "CART"]
+        return capacity - sum(self.cargo.values())
+
+    def spend_fuel_to_survive(self):
+        upkeep = SIM_PARAMETERS["LIGHT_UPKEEP"]["WORKER" if self.is_worker() else "CART"]
+        for r_type in RESOURCE_PLANES:
+            rate = SIM_PARAMETERS["RESOURCE_TO_FUEL_RATE"][r_type.upper()]
+            spent = min(self.cargo[r_type], math.ceil(upkeep / rate))
+            upkeep -= spent * rate
+            self.cargo[r_type] -= spent
+            if upkeep <= 0:
+                return True
+        return False
+
+
+class SimCityTile:
+    def __init__(self, team, cityid, cooldown=0.0):
+        self.team = team
+        self.cityid = cityid
+        self.cooldown = cooldown
+        # number of our own city tiles next to this one when it was built, plus those built next to it since
+        self.adjacent = 0
+
+
+class SimCity:
+    def __init__(self, team, cityid, fuel=0.0):
+        self.team = team
+        self.id = cityid
+        self.fuel = fuel
+        self.tiles = []
+
+
+class LuxSim:
+    def __init__(self, updates, episode_steps=361):
+        # updates is the step 0 observation of a game, starting with the player id and map size lines
+        self.width, self.height = map(int, updates[1].split(" "))
+        self.episode_steps = episode_steps
+        self.turn = 0
+        self.done = False
+        self.research_points = [0, 0]
+        self.units = [{}, {}]
+        self.cities = {}
+        self.city_tiles = {}
+        self.road = np.zeros((self.height, self.width))
+        # resources mined by each team so far, by type
+        self.collected = [dict.fromkeys(RESOURCE_PLANES, 0), dict.fromkeys(RESOURCE_PLANES, 0)]
+        resources = []
+        for update in updates[2:]:
+            strs = update.split(" ")
+            if strs[0] == "rp":
+                self.research_points[int(strs[1])] = int(strs[2])
+            elif strs[0] == "r":
+                resources.append((RESOURCE_PLANES.index(strs[1]), int(strs[2]), int(strs[3]), int(float(strs[4]))))
+            elif strs[0] == "u":
+                unit = SimUnit(int(strs[2]), int(strs[1]), strs[3], int(strs[4]), int(strs[5]), float(strs[6]), *map(int, strs[7:10]))
+                self.units[unit.team][unit.id] = unit
+            elif strs[0] == "c":
+                self.cities[strs[2]] = SimCity(int(strs[1]), strs[2], float(strs[3]))
+            elif strs[0] == "ct":
+                self._spawn_city_tile(int(strs[1]), int(strs[3]), int(strs[4]), strs[2]).cooldown = float(strs[5])
+            elif strs[0] == "ccd":
+                self.road[int(strs[2]), int(strs[1])] = float(strs[3])
+        # resource tiles are kept as parallel arrays in the order the engine lists them
+        self.resource_type, self.resource_x, self.resource_y, self.resource_amount = (
+            np.array(column, dtype=np.int64) for column in zip(*resources)) if resources else (np.zeros(0, dtype=np.int64),) * 4
+        self._index_resources()
+        self.unit_id_count = max([int(unit_id[2:]) for team_units in self.units for unit_id in team_units] + [0])
+        self.city_id_count = max([int(cityid[2:]) for cityid in self.cities] + [0])
+
+    def _index_resources(self):
+        self.resource_at = {(x, y): i for i, (x, y) in enumerate(zip(self.resource_x.tolist(), self.resource_y.tolist()))}
+
+    def in_map(self, x, y):
+        return 0 <= x < self.width and 0 <= y < self.height
+
+    def is_night(self):
+        day = SIM_PARAMETERS["DAY_LENGTH"]
+        return self.turn % (day + SIM_PARAMETERS["NIGHT_LENGTH"]) >= day
+
+    def researched(self, team, r_type):
+        if r_type == Constants.RESOURCE_TYPES.WOOD:
+            return True
+        return self.research_points[team] >= SIM_PARAMETERS["RESEARCH_REQUIREMENTS"][r_type.upper()]
+
+    def get_road(self, x, y):
+        return SIM_PARAMETERS["MAX_ROAD"] if (x, y) in self.city_tiles else self.road[y, x]
+
+    def has_resource(self, x, y):
+        i = self.resource_at.get((x, y))
+        return i is not None and self.resource_amount[i] > 0
+
+    def city_upkeep(self, city):
+        adjacency = sum(self.city_tiles[pos].adjacent for pos in city.tiles)
+        return len(city.tiles) * SIM_PARAMETERS["LIGHT_UPKEEP"]["CITY"] - adjacency * SIM_PARAMETERS["CITY_ADJACENCY_BONUS"]
+
+    def _spawn_unit(self, team, u_type, x, y):
+        self.unit_id_count += 1
+        unit = SimUnit(team, u_type, "u_{}".format(self.unit_id_count), x, y)
+        self.units[team][unit.id] = unit
+
+    def _spawn_city_tile(self, team, x, y, cityid=None):
+        neighbours = [(x, y - 1), (x + 1, y), (x, y + 1), (x - 1, y)]
+        adjacent = [pos for pos in neighbours if pos in self.city_tiles and self.city_tiles[pos].team == team]
+        if not adjacent:
+            if cityid is None:
+                self.city_id_count += 1
+                cityid = "c_{}".format(self.city_id_count)
+            self.cities.setdefault(cityid, SimCity(team, cityid))
+            tile = self.city_tiles[(x, y)] = SimCityTile(team, cityid)
+            self.cities[cityid].tiles.append((x, y))
+            return tile
+        # the new tile joins the city of its first neighbour and merges every other neighbouring city into it
+        cityid = self.city_tiles[adjacent[0]].cityid
+        city = self.cities[cityid]
+        tile = self.city_tiles[(x, y)] = SimCityTile(team, cityid)
+        tile.adjacent = len(adjacent)
+        for pos in adjacent:
+            self.city_tiles[pos].adjacent += 1
+        city.tiles.append((x, y))
+        for other_id in dict.fromkeys(self.city_tiles[pos].cityid for pos in adjacent):
+            if other_id != cityid:
+                other = self.cities.pop(other_id)
+                for pos in other.tiles:
+                    self.city_tiles[pos].cityid = cityid
+                    city.tiles.append(pos)
+                city.fuel += other.fuel
+        return tile
+
+    def _destroy_city(self, cityid):
+        for x, y in self.cities.pop(cityid).tiles:
+            del self.city_tiles[(x, y)]
+            self.road[y, x] = SIM_PARAMETERS["MIN_ROAD"]
+
+    def _validate(self, team, command, placed, built):
+        # returns a parsed action, or None if the engine would reject the command
+        strs = command.split(" ")
+        units = self.units[team]
+        if strs[0] in ("m", "p", "bcity", "t"):
+            unit = units.get(strs[1]) if len(strs) > 1 else None
+            if unit is None or unit.cooldown >= 1 or unit.id in placed:
+                return None
+            if strs[0] == "m":
+                if len(strs) != 3 or strs[2] not in DIRECTION_DELTAS:
+                    return None
+                dx, dy = DIRECTION_DELTAS[strs[2]]
+                x, y = unit.x + dx, unit.y + dy
+                if not self.in_map(x, y) or ((x, y) in self.city_tiles and self.city_tiles[(x, y)].team != team):
+                    return None
+                action = ("m", unit, strs[2], (x, y))
+            elif strs[0] == "p":
+                if len(strs) != 2:
+                    return None
+                action = ("p", unit)
+            elif strs[0] == "bcity":
+                if len(strs) != 2 or (unit.x, unit.y) in self.city_tiles or self.has_resource(unit.x, unit.y):
+                    return None
+                if sum(unit.cargo.values()) < SIM_PARAMETERS["CITY_BUILD_COST"]:
+                    return None
+                action = ("bcity", unit)
+            else:
+                if len(strs) != 5 or strs[2] not in units or strs[1] == strs[2] or strs[3] not in unit.cargo:
+                    return None
+                dest = units[strs[2]]
+                if abs(dest.x - unit.x) + abs(dest.y - unit.y) > 1:
+                    return None
+                try:
+                    amount = int(strs[4])
+                except ValueError:
+                    return None
+                if amount < 0:
+                    return None
+                action = ("t", unit, dest, strs[3], amount)
+            placed.add(unit.id)
+            return action
+        if strs[0] in ("r", "bw", "bc"):
+            try:
+                x, y = int(strs[1]), int(strs[2])
+            except (IndexError, ValueError):
+                return None
+            tile = self.city_tiles.get((x, y))
+            if len(strs) != 3 or not self.in_map(x, y) or tile is None or tile.team != team:
+                return None
+            if (x, y) in placed or tile.cooldown >= 1:
+                return None
+            if strs[0] != "r":
+                city_tile_count = sum(len(city.tiles) for city in self.cities.values() if city.team == team)
+                if len(units) + built[team] >= city_tile_count:
+                    return None
+                built[team] += 1
+            placed.add((x, y))
+            return (strs[0], tile, x, y)
+        return None
+
+    def _resolve_moves(self, moves):
+        # the engine's collision rules: moves onto the same tile cancel each other unless it is a city tile, moves onto a
+        # tile with a unit that isn't moving are cancelled, and cancelling a move cancels the moves onto that unit's tile
+        by_cell = {}
+        for move in moves:
+            by_cell.setdefault(move[3], []).append(move)
+        moving = {move[1].id for move in moves}
+        occupants = {}
+        for team_units in self.units:
+            for unit in team_units.values():
+                occupants.setdefault((unit.x, unit.y), []).append(unit)
+
+        def cancel(move):
+            pos = (move[1].x, move[1].y)
+            if pos not in self.city_tiles:
+                for other in by_cell.pop(pos, []):
+                    cancel(other)
+
+        for pos in list(by_cell):
+            cell_moves = by_cell.get(pos)
+            cancelled = []
+            if cell_moves is None or pos in self.city_tiles:
+                continue
+            if len(cell_moves) > 1:
+                cancelled = list(cell_moves)
+            elif len(occupants.get(pos, [])) == 1 and occupants[pos][0].id not in moving:
+                cancelled = list(cell_moves)
+            for move in cancelled:
+                cancel(move)
+            for move in cancelled:
+                by_cell.pop(move[3], None)
+        return [move for cell_moves in by_cell.values() for move in cell_moves if move[2] != Constants.DIRECTIONS.CENTER]
+
+    def _transfer(self, unit, dest, r_type, amount):
+        amount = min(amount, unit.cargo[r_type], dest.cargo_space_left())
+        unit.cargo[r_type] -= amount
+        dest.cargo[r_type] += amount
+
+    def _collect_resources(self):
+        for r_type in MINING_ORDER:
+            plane = RESOURCE_PLANES.index(r_type)
+            rate = SIM_PARAMETERS["WORKER_COLLECTION_RATE"][r_type.upper()]
+            fuel_rate = SIM_PARAMETERS["RESOURCE_TO_FUEL_RATE"][r_type.upper()]
+            # every worker asks each tile of this type next to or under it for an equal share of its free cargo space
+            requests = {}
+            for team in (0, 1):
+                if not self.researched(team, r_type):
+                    continue
+                for unit in self.units[team].values():
+                    if not unit.is_worker():
+                        continue
+                    cells = []
+                    for direction in ALL_DIRECTIONS:
+                        dx, dy = DIRECTION_DELTAS[direction]
+                        i = self.resource_at.get((unit.x + dx, unit.y + dy))
+                        if i is not None and self.resource_type[i] == plane and self.resource_amount[i] > 0:
+                            cells.append(i)
+                    if not cells:
+                        continue
+                    amount = min(math.ceil(unit.cargo_space_left() / len(cells)), rate)
+                    # workers on a city tile mine straight into the city, and identical requests are only counted once
+                    tile = self.city_tiles.get((unit.x, unit.y))
+                    request = (unit.x, unit.y, amount, None if tile else unit.id, tile.cityid if tile else None)
+                    for i in cells:
+                        cell_requests = requests.setdefault(i, {})
+                        if request not in cell_requests:
+                            cell_requests[request] = unit
+            for i, cell_requests in requests.items():
+                left = int(self.resource_amount[i])
+                pending = [[request[2], request, unit] for request, unit in cell_requests.items()]
+                while pending and sum(amount for amount, _, _ in pending) > 0 and left > 0:
+                    share = min(min(amount for amount, _, _ in pending), left // len(pending))
+                    for _, request, unit in pending:
+                        if request[4] is not None:
+                            self.cities[request[4]].fuel += share * fuel_rate
+                            self.collected[unit.team][r_type] += share
+                        else:
+                            mined = min(unit.cargo_space_left(), share)
+                            unit.cargo[r_type] += mined
+                            self.collected[unit.team][r_type] += mined
+                    for entry in pending:
+                        entry[0] -= share
+                    left -= share * len(pending)
+                    if left < len(pending):
+                        left = 0
+                    pending = [entry for entry in pending if entry[0] > 0]
+                self.resource_amount[i] = left
+
+    def step(self, actions):
+        # actions is a list with the list of commands of each player
+        night = self.is_night()
+        placed, built = [set(), set()], [0, 0]
+        parsed = []
+        for team in (0, 1):
+            for command in actions[team] or []:
+                action = self._validate(team, command, placed[team], built)
+                if action is not None:
+                    parsed.append(action)
+        unit_actions = {action[1].id: action for action in parsed if action[0] in ("p", "bcity", "t")}
+        tile_actions = {(action[2], action[3]): action for action in parsed if action[0] in ("r", "bw", "bc")}
+        for move in self._resolve_moves([action for action in parsed if action[0] == "m"]):
+            unit_actions[move[1].id] = move
+
+        for city in list(self.cities.values()):
+            for x, y in city.tiles:
+                tile = self.city_tiles[(x, y)]
+                action = tile_actions.get((x, y))
+                if action is not None:
+                    if action[0] == "r":
+                        self.research_points[tile.team] += 1
+                    else:
+                        u_type = Constants.UNIT_TYPES.WORKER if action[0] == "bw" else Constants.UNIT_TYPES.CART
+                        self._spawn_unit(tile.team, u_type, x, y)
+                    tile.cooldown = SIM_PARAMETERS["CITY_ACTION_COOLDOWN"]
+                if tile.cooldown > 0:
+                    tile.cooldown -= 1
+
+        for team in (0, 1):
+            for unit in list(self.units[team].values()):
+                action = unit_actions.get(unit.id)
+                # carts can only move and transfer, anything else they were given is dropped
+                if action is not None and not unit.is_worker() and action[0] not in ("m", "t"):
+                    action = None
+                if action is not None:
+                    if action[0] == "m":
+                        unit.x, unit.y = action[3]
+                    elif action[0] == "t":
+                        self._transfer(unit, action[2], action[3], action[4])
+                    elif action[0] == "bcity":
+                        self._spawn_city_tile(team, unit.x, unit.y)
+                        spent = 0
+                        for r_type in RESOURCE_PLANES:
+                            if spent + unit.cargo[r_type] > SIM_PARAMETERS["CITY_BUILD_COST"]:
+                                unit.cargo[r_type] -= SIM_PARAMETERS["CITY_BUILD_COST"] - spent
+                                break
+                            spent += unit.cargo[r_type]
+                            unit.cargo[r_type] = 0
+                    elif action[0] == "p":
+                        self.road[unit.y, unit.x] = max(self.road[unit.y, unit.x] - SIM_PARAMETERS["PILLAGE_RATE"], SIM_PARAMETERS["MIN_ROAD"])
+                    unit.cooldown += SIM_PARAMETERS["UNIT_ACTION_COOLDOWN"]["WORKER" if unit.is_worker() else "CART"] * (2 if night else 1)
+                if not unit.is_worker() and self.get_road(unit.x, unit.y) < SIM_PARAMETERS["MAX_ROAD"]:
+                    self.road[unit.y, unit.x] = min(self.road[unit.y, unit.x] + SIM_PARAMETERS["CART_ROAD_DEVELOPMENT_RATE"], SIM_PARAMETERS["MAX_ROAD"])
+
+        self._collect_resources()
+
+        for team in (0, 1):
+            for unit in self.units[team].values():
+                tile = self.city_tiles.get((unit.x, unit.y))
+                if tile is not None and tile.team == team:
+                    self.cities[tile.cityid].fuel += sum(unit.cargo[r_type] * SIM_PARAMETERS["RESOURCE_TO_FUEL_RATE"][r_type.upper()] for r_type in RESOURCE_PLANES)
+                    unit.cargo = {r_type: 0 for r_type in RESOURCE_PLANES}
+
+        if night:
+            for city in list(self.cities.values()):
+                upkeep = self.city_upkeep(city)
+                if city.fuel < upkeep:
+                    self._destroy_city(city.id)
+                else:
+                    city.fuel -= upkeep
+            for team in (0, 1):
+                for unit in list(self.units[team].values()):
+                    if (unit.x, unit.y) not in self.city_tiles and not unit.spend_fuel_to_survive():
+                        del self.units[team][unit.id]
+
+        # depleted tiles disappear and forests that are left regrow
+        if (self.resource_amount <= 0).any():
+            keep = self.resource_amount > 0
+            self.resource_type, self.resource_x, self.resource_y, self.resource_amount = (
+                self.resource_type[keep], self.resource_x[keep], self.resource_y[keep], self.resource_amount[keep])
+            self._index_resources()
+        growing = (self.resource_type == 0) & (self.resource_amount < SIM_PARAMETERS["MAX_WOOD_AMOUNT"])
+        self.resource_amount[growing] = np.ceil(np.minimum(
+            self.resource_amount[growing] * SIM_PARAMETERS["WOOD_GROWTH_RATE"], SIM_PARAMETERS["MAX_WOOD_AMOUNT"]))
+
+        city_tile_counts = [0, 0]
+        for tile in self.city_tiles.values():
+            city_tile_counts[tile.team] += 1
+        eliminated = any(len(self.units[team]) + city_tile_counts[team] == 0 for team in (0, 1))
+
+        self.turn += 1
+        for team_units in self.units:
+            for unit in team_units.values():
+                unit.cooldown = max(unit.cooldown - self.get_road(unit.x, unit.y) - 1, 0)
+        self.done = eliminated or self.turn >= self.episode_steps - 1
+
+    def rewards(self):
+        # same as the kaggle environment: city tiles first, units to break ties
+        rewards = [len(self.units[team]) for team in (0, 1)]
+        for tile in self.city_tiles.values():
+            rewards[tile.team] += 10000
+        return rewards
+
+    def updates(self):
+        # the update lines the engine would send for the current turn
+        lines = ["rp 0 {}".format(self.research_points[0]), "rp 1 {}".format(self.research_points[1])]
+        for r_type, x, y, amount in zip(self.resource_type.tolist(), self.resource_x.tolist(), self.resource_y.tolist(), self.resource_amount.tolist()):
+            lines.append("r {} {} {} {}".format(RESOURCE_PLANES[r_type], x, y, amount))
+        for team in (0, 1):
+            for unit in self.units[team].values():
+                lines.append("u {} {} {} {} {} {} {} {} {}".format(
+                    unit.type, team, unit.id, unit.x, unit.y, js_number(unit.cooldown), *unit.cargo.values()))
+        for city in self.cities.values():
+            lines.append("c {} {} {} {}".format(city.team, city.id, js_number(city.fuel), js_number(self.city_upkeep(city))))
+        for city in self.cities.values():
+            for x, y in city.tiles:
+                lines.append("ct {} {} {} {} {}".format(city.team, city.id, x, y, js_number(self.city_tiles[(x, y)].cooldown)))
+        for y in range(self.height):
+            for x in range(self.width):
+                road = self.get_road(x, y)
+                if road != 0:
+                    lines.append("ccd {} {} {}".format(x, y, js_number(road)))
+        lines.append("D_DONE")
+        return lines
+
+
+# To make sure the simulator plays by the same rules as the engine, we play a game with the engine, feed the same actions into the simulator and compare the update lines of every turn
+
+# In[49]:
+
+
+import random
+
+# plays a game on the engine, replays its actions in the simulator and returns the first turn where they disagree
+def check_simulator(seed, agents):
+    env = make("lux_ai_2021", configuration={"seed": seed, "loglevel": 0, "annotations": False}, debug=False)
+    steps = env.run(agents)
+    sim = LuxSim(steps[0][0]["observation"]["updates"], env.configuration.episodeSteps)
+    for t in range(1, len(steps)):
+        sim.step([agent_state["action"] for agent_state in steps[t]])
+        expected = steps[t][0]["observation"]["updates"]
+        if sim.updates() != expected:
+            return t, sorted(set(sim.updates()) ^ set(expected))
+    return None
+
+# neither our agent nor simple_agent builds or researches anything, so we also check games between two agents that
+# try every action at random: cities next to each other that merge, workers, carts, research, transfers and pillaging
+def random_builder(seed):
+    rng = random.Random(seed)
+    game_state = Game()
+    def agent(observation, configuration):
+        if observation["step"] == 0:
+            game_state._initialize(observation["updates"])
+            game_state._update(observation["updates"][2:])
+        else:
+            game_state._update(observation["updates"])
+        player = game_state.players[observation.player]
+        units_at = {(unit.pos.x, unit.pos.y): unit for unit in player.units}
+        actions = []
+        for unit in player.units:
+            if not unit.can_act():
+                continue
+            roll = rng.random()
+            neighbours = [units_at.get((unit.pos.x + dx, unit.pos.y + dy)) for _, dx, dy in DIRECTION_STEPS]
+            neighbours = [neighbour for neighbour in neighbours if neighbour is not None]
+            cargo = max(("wood", "coal", "uranium"), key=lambda r_type: getattr(unit.cargo, r_type))
+            if roll < 0.8 and unit.can_build(game_state.map):
+                actions.append(unit.build_city())
+            elif roll < 0.2 and neighbours and getattr(unit.cargo, cargo) > 0:
+                actions.append(unit.transfer(rng.choice(neighbours).id, cargo, getattr(unit.cargo, cargo)))
+            elif roll < 0.25 and unit.is_worker():
+                actions.append(unit.pillage())
+            elif roll < 0.6:
+                # staying put the rest of the time lets workers fill up next to resources and build
+                actions.append(unit.move(rng.choice("nesw")))
+        for city in player.cities.values():
+            for city_tile in city.citytiles:
+                if city_tile.can_act():
+                    actions.append(rng.choice([city_tile.research(), city_tile.build_worker(), city_tile.build_cart()]))
+        return actions
+    return agent
+
+for seed in [562124210, 1, 2, 3]:
+    print(seed, check_simulator(seed, [agent, "simple_agent"]) or "simulator matches the engine")
+    print(seed, check_simulator(seed, [random_builder(seed), random_builder(seed + 1)]) or "simulator matches the engine with random builders")
+
+# and how much faster it is, replaying the actions of the last game
+env = make("lux_ai_2021", configuration={"seed": 562124210, "loglevel": 0}, debug=False)
+start = time.perf_counter()
+steps = env.run([agent, "simple_agent"])
+engine_time = time.perf_counter() - start
+sim = LuxSim(steps[0][0]["observation"]["updates"])
+start = time.perf_counter()
+for agent_states in steps[1:]:
+    sim.step([agent_state["action"] for agent_state in agent_states])
+sim_time = time.perf_counter() - start
+print("engine (including our agent): {:.0f} steps/s, simulator: {:.0f} steps/s".format(len(steps) / engine_time, len(steps) / sim_time))
+
+
+# ## Stepping Many Games at Once
+# 
+# With the simulator in-process we can run many games side by side and let a policy act on all of them with one call, which is how we want to generate self-play data. `BatchLuxEnv` keeps K simulated games and steps them in lockstep. Observations come out as stacked arrays in the same layout as the replay dataset: `[K, 2, len(FEATURE_PLANES), 32, 32]` planes and `[K, 2, len(SCALAR_FEATURES)]` scalars, one slice per game and player, so a model trained on replays can act in the batch directly. Actions go in as planes of indices into `UNIT_ACTIONS` and `CITY_ACTIONS` for every game and player, and are turned back into commands for the units and city tiles on those tiles. A finished game is replaced with a fresh one straight away, and its final rewards are reported in `info`.
+# 
+# Since the action planes have no room for a transfer target, a `t` gives the unit's largest cargo to the first of our units next to it.
+
+# In[50]:
+
+
+# the step 0 observation of a game, used to start simulated games on the same maps as the engine
+@functools.lru_cache(maxsize=None)
+def initial_updates(seed, size=None):
+    configuration = {"seed": seed, "loglevel": 0}
+    if size is not None:
+        configuration["width"] = configuration["height"] = size
+    env = make("lux_ai_2021", configuration=configuration, debug=False)
+    env.reset()
+    return tuple(env.state[0]["observation"]["updates"])
+
+# fills planes and scalars with the same features state_planes and state_scalars compute, straight from a simulator
+def sim_features(sim, planes, scalars):
+    planes[:] = 0
+    height, width = sim.height, sim.width
+    planes[:, 9, :height, :width] = 1
+    planes[:, 5, :height, :width] = sim.road
+    planes[:, sim.resource_type, sim.resource_y, sim.resource_x] = sim.resource_amount
+    for (x, y), tile in sim.city_tiles.items():
+        planes[tile.team, 3, y, x] = 1
+        planes[1 - tile.team, 4, y, x] = 1
+        planes[:, 5, y, x] = SIM_PARAMETERS["MAX_ROAD"]
+    for team in (0, 1):
+        for unit in sim.units[team].values():
+            planes[team, 6, unit.y, unit.x] += 1
+            planes[1 - team, 7, unit.y, unit.x] += 1
+            planes[team, 8, unit.y, unit.x] += sum(unit.cargo.values())
+    for team in (0, 1):
+        scalars[team] = sim.turn, sim.research_points[team], sim.research_points[1 - team], sim.is_night()
+
+# the commands for one player from planes of UNIT_ACTIONS and CITY_ACTIONS indices
+def plane_commands(sim, team, unit_actions, city_actions):
+    commands = []
+    units = list(sim.units[team].values())
+    for unit in units:
+        action = UNIT_ACTIONS[unit_actions[unit.y, unit.x]]
+        if action == "none":
+            continue
+        if action == "t":
+            neighbours = [other for other in units if abs(other.x - unit.x) + abs(other.y - unit.y) == 1]
+            if neighbours:
+                r_type = max(unit.cargo, key=unit.cargo.get)
+                commands.append("t {} {} {} {}".format(unit.id, neighbours[0].id, r_type, unit.cargo[r_type]))
+        elif action in ("bcity", "p"):
+            commands.append("{} {}".format(action, unit.id))
+        else:
+            commands.append("m {} {}".format(unit.id, action[2]))
+    for (x, y), tile in sim.city_tiles.items():
+        action = CITY_ACTIONS[city_actions[y, x]]
+        if tile.team == team and action != "none":
+            commands.append("{} {} {}".format(action, x, y))
+    return commands
+
+
+class BatchLuxEnv:
+    def __init__(self, num_envs, seeds, size=None, episode_steps=361):
+        # new games cycle through seeds, every seed gives the engine's map for that seed
+        self.num_envs = num_envs
+        self.seeds = list(seeds)
+        self.size = size
+        self.episode_steps = episode_steps
+        self.games_started = 0
+        self.sims = [None] * num_envs
+        self.planes = np.zeros((num_envs, 2, len(FEATURE_PLANES), MAX_MAP_SIZE, MAX_MAP_SIZE), dtype=np.float32)
+        self.scalars = np.zeros((num_envs, 2, len(SCALAR_FEATURES)), dtype=np.float32)
+
+    def _new_game(self, k):
+        seed = self.seeds[self.games_started % len(self.seeds)]
+        self.games_started += 1
+        self.sims[k] = LuxSim(initial_updates(seed, self.size), self.episode_steps)
+        sim_features(self.sims[k], self.planes[k], self.scalars[k])
+
+    def reset(self):
+        for k in range(self.num_envs):
+            self._new_game(k)
+        return self.planes.copy(), self.scalars.copy()
+
+    def step(self, unit_actions, city_actions):
+        # unit_actions and city_actions are [K, 2, 32, 32] arrays of action indices
+        rewards = np.zeros((self.num_envs, 2), dtype=np.int64)
+        dones = np.zeros(self.num_envs, dtype=bool)
+        info = {"final_rewards": {}}
+        for k, sim in enumerate(self.sims):
+            sim.step([plane_commands(sim, team, unit_actions[k, team], city_actions[k, team]) for team in (0, 1)])
+            rewards[k] = sim.rewards()
+            if sim.done:
+                dones[k] = True
+                info["final_rewards"][k] = rewards[k].tolist()
+                self._new_game(k)
+            else:
+                sim_features(sim, self.planes[k], self.scalars[k])
+        return self.planes.copy(), self.scalars.copy(), rewards, dones, info
+
+
+# To try it out, here is a policy that acts on the whole batch with a handful of NumPy operations: every unit moves towards more resources in its neighbourhood, builds a city tile once it carries enough, and city tiles build workers or research at random
+
+# In[51]:
+
+
+def batch_policy(planes, scalars, rng=np.random):
+    # planes is [K, 2, planes, 32, 32], the result has one action index per tile for every game and player
+    resources = planes[:, :, 0:3].sum(axis=2)
+    scores = np.stack([np.roll(resources, shift, axis=axis) for shift, axis in [(1, 2), (-1, 3), (-1, 2), (1, 3)]], axis=2)
+    # np.roll looks at the tile north, east, south and west of every tile, in the order of UNIT_ACTIONS
+    unit_actions = (scores.argmax(axis=2) + 1).astype(np.int8)
+    unit_actions[scores.max(axis=2) == 0] = UNIT_ACTIONS.index("m c")
+    unit_actions[planes[:, :, 8] >= SIM_PARAMETERS["CITY_BUILD_COST"]] = UNIT_ACTIONS.index("bcity")
+    unit_actions[planes[:, :, 6] == 0] = 0
+    city_actions = rng.choice([CITY_ACTIONS.index("r"), CITY_ACTIONS.index("bw")], size=unit_actions.shape).astype(np.int8)
+    city_actions[planes[:, :, 3] == 0] = 0
+    return unit_actions, city_actions
+
+batch_env = BatchLuxEnv(16, seeds=[562124210, 1, 2, 3])
+planes, scalars = batch_env.reset()
+start = time.perf_counter()
+finished = []
+for _ in range(720):
+    planes, scalars, rewards, dones, info = batch_env.step(*batch_policy(planes, scalars))
+    finished.extend(info["final_rewards"].values())
+elapsed = time.perf_counter() - start
+print("{} games finished, {:.0f} game steps/s across the batch".format(len(finished), 720 * batch_env.num_envs / elapsed))
+print("final rewards of the first few:", finished[:4])
+
+
+# ## Which City Needs Fuel Most?
+# 
+# Our workers bring their cargo to whichever city tile is closest, with no idea whether that city has enough fuel for the coming night or is about to go dark. Working that out means looking at every city's fuel and upkeep and counting the night turns ahead, and doing it for every unit on every turn repeats the same sums many times.
+# 
+# `CityForecaster` keeps a copy of each city's fuel, upkeep and tiles, and after every `_update` it only looks at the cities whose numbers changed. For every city it works out the turn the city will go dark if nobody brings it more fuel. That turn doesn't change until the city's fuel, upkeep or tiles do, so it is cached and only recomputed for the cities whose lines changed. During the day a city's fuel stays put and nothing needs recomputing at all. `most_at_risk` then finds the city that goes dark first among those with a tile within a given distance of a unit.
+
+# In[52]:
+
+
+# how far a full worker will go out of its way for a city that is about to go dark
+DELIVERY_DISTANCE = 6
+
+# the turns remaining until night starts, 0 during the night
+def turns_until_night(step):
+    day = GAME_CONSTANTS["PARAMETERS"]["DAY_LENGTH"]
+    return max(day - step % (day + GAME_CONSTANTS["PARAMETERS"]["NIGHT_LENGTH"]), 0)
+
+# the first turn from step onwards on which a city with this much fuel and upkeep can't pay its upkeep, or None if it
+# lasts until the end of the game
+def dark_turn(fuel, upkeep, step, last_turn=GAME_CONSTANTS["PARAMETERS"]["MAX_DAYS"]):
+    day = GAME_CONSTANTS["PARAMETERS"]["DAY_LENGTH"]
+    cycle = day + GAME_CONSTANTS["PARAMETERS"]["NIGHT_LENGTH"]
+    nights = int(fuel // upkeep) if upkeep > 0 else math.inf
+    turn = step
+    while turn < last_turn:
+        night_start = turn - turn % cycle + day
+        if turn < night_start:
+            turn = night_start
+        night_turns = (turn - turn % cycle + cycle) - turn
+        if nights < night_turns:
+            turn += nights
+            return turn if turn < last_turn else None
+        nights -= night_turns
+        turn += night_turns
+    return None
+
+
+class CityForecaster:
+    def __init__(self):
+        # cityid -> team, fuel, upkeep and the (x, y) of its tiles
+        self.cities = {}
+        # cityid -> the turn it goes dark, dropped whenever the city changes
+        self.forecasts = {}
+        self._ranked = None
+        self.step = 0
+
+    def update(self, game_state, step):
+        # the Game has already read this turn's city lines, so we only compare each city's fuel, upkeep and number of
+        # tiles with what we saw last turn. Tiles are only ever added or lost together with the whole city
+        seen = set()
+        changed = False
+        for player in game_state.players:
+            for cityid, city in player.cities.items():
+                seen.add(cityid)
+                cached = self.cities.get(cityid)
+                if cached is None or cached[1] != city.fuel or cached[2] != city.get_light_upkeep() or len(cached[3]) != len(city.citytiles):
+                    self.cities[cityid] = [player.team, city.fuel, city.get_light_upkeep(), [(city_tile.pos.x, city_tile.pos.y) for city_tile in city.citytiles]]
+                    self.forecasts.pop(cityid, None)
+                    changed = True
+        for cityid in [cityid for cityid in self.cities if cityid not in seen]:
+            del self.cities[cityid]
+            self.forecasts.pop(cityid, None)
+            changed = True
+        if changed:
+            self._ranked = None
+        self.step = step
+
+    def dark_turn(self, cityid):
+        # a city burns fuel on every night turn, so as long as its line is unchanged we are still in the same day and
+        # the turn it goes dark is still the same
+        if cityid not in self.forecasts:
+            _, fuel, upkeep, _ = self.cities[cityid]
+            self.forecasts[cityid] = dark_turn(fuel, upkeep, self.step)
+        return self.forecasts[cityid]
+
+    def fuel_needed(self, cityid):
+        # the fuel the city still needs to get through the end of the next night
+        _, fuel, upkeep, _ = self.cities[cityid]
+        day = GAME_CONSTANTS["PARAMETERS"]["DAY_LENGTH"]
+        cycle = day + GAME_CONSTANTS["PARAMETERS"]["NIGHT_LENGTH"]
+        night_turns_left = min(cycle - self.step % cycle, cycle - day)
+        return max(upkeep * night_turns_left - fuel, 0)
+
+    def report(self):
+        return pd.DataFrame([{
+            "cityid": cityid, "team": team, "tiles": len(tiles), "fuel": fuel, "upkeep": upkeep,
+            "turns_until_night": turns_until_night(self.step), "dark_turn": self.dark_turn(cityid),
+            "fuel_needed": self.fuel_needed(cityid),
+        } for cityid, (team, fuel, upkeep, tiles) in self.cities.items()])
+
+    def ranked(self):
+        # cityids from the one that goes dark first, cities that last the whole game come last
+        if self._ranked is None:
+            self._ranked = sorted(self.cities, key=lambda cityid: (self.dark_turn(cityid) is None, self.dark_turn(cityid) or 0, cityid))
+        return self._ranked
+
+    def most_at_risk(self, pos, distance, team):
+        # returns (cityid, (x, y) of its closest tile) for the city of team that goes dark first and has a tile within
+        # distance of pos, or None if none of them will go dark before the game ends
+        for cityid in self.ranked():
+            city_team, _, _, tiles = self.cities[cityid]
+            if city_team != team or self.dark_turn(cityid) is None:
+                continue
+            closest = min(tiles, key=lambda tile: (abs(tile[0] - pos.x) + abs(tile[1] - pos.y), tile[1], tile[0]))
+            if abs(closest[0] - pos.x) + abs(closest[1] - pos.y) <= distance:
+                return cityid, closest
+        return None
+
+
+# the way to single tiles around the same obstacles as target_fields. Each distance field is a pass over the whole map,
+# so a unit only gets one when something is in the way, and at most max_fields of them are built per turn
+class TileFields:
+    def __init__(self, arrays, team, max_fields=8):
+        self.blocked = movement_blockers(arrays, team)
+        self.max_fields = max_fields
+        self.fields = {}
+
+    def directions(self, pos, target):
+        # every direction that takes a unit at pos closer to the (x, y) target, best first, or [] if it can't get there
+        x, y = target
+        if self.blocked[y, x]:
+            return []
+        # with nothing in the rectangle between the unit and the target, every straight step is on a shortest way there
+        if not self.blocked[min(pos.y, y):max(pos.y, y) + 1, min(pos.x, x):max(pos.x, x) + 1].any():
+            return directions_towards(pos, target)
+        if target not in self.fields:
+            if len(self.fields) >= self.max_fields:
+                # out of fields for this turn, so take whichever straight steps are free
+                steps = [(direction, pos.translate(direction, 1)) for direction in directions_towards(pos, target)]
+                return [direction for direction, step in steps if not self.blocked[step.y, step.x]]
+            targets = np.zeros_like(self.blocked)
+            targets[y, x] = True
+            self.fields[target] = bfs_distance_field(targets, self.blocked)
+        return ranked_directions_from_field(self.fields[target], pos)
+
+
+# the directions that take a unit at pos closer to target, along the longer way first
+def directions_towards(pos, target):
+    dx, dy = target[0] - pos.x, target[1] - pos.y
+    if dx == 0 and dy == 0:
+        return [Constants.DIRECTIONS.CENTER]
+    directions = []
+    if dx != 0:
+        directions.append((abs(dx), Constants.DIRECTIONS.EAST if dx > 0 else Constants.DIRECTIONS.WEST))
+    if dy != 0:
+        directions.append((abs(dy), Constants.DIRECTIONS.SOUTH if dy > 0 else Constants.DIRECTIONS.NORTH))
+    return [direction for _, direction in sorted(directions, key=lambda step: -step[0])]
+
+
+# The straightforward way to get the same answer is to walk all of the player's cities and their tiles for every unit that wants to deliver. We replay the saved game through both, ask for every unit of both players on every turn, and check that the answers agree. The saved game only has a city or two per player, so there is little to save here; the difference grows with the number of cities and units
+
+# In[53]:
+
+
+def most_at_risk_city(player, pos, distance, step):
+    best = None
+    for city in player.cities.values():
+        turn = dark_turn(city.fuel, city.get_light_upkeep(), step)
+        if turn is None:
+            continue
+        closest = min(city.citytiles, key=lambda city_tile: (city_tile.pos.distance_to(pos), city_tile.pos.y, city_tile.pos.x))
+        if closest.pos.distance_to(pos) <= distance and (best is None or (turn, city.cityid) < best[0]):
+            best = ((turn, city.cityid), (city.cityid, (closest.pos.x, closest.pos.y)))
+    return best and best[1]
+
+replay_game = Game()
+forecaster = CityForecaster()
+naive_time = forecast_time = 0
+for step, (lines, _) in enumerate(replay_turns("replay.json")):
+    if step == 0:
+        replay_game._initialize(lines)
+        lines = lines[2:]
+    replay_game._update(lines)
+    start = time.perf_counter()
+    forecaster.update(replay_game, step)
+    forecasts = [forecaster.most_at_risk(unit.pos, DELIVERY_DISTANCE, player.team) for player in replay_game.players for unit in player.units]
+    forecast_time += time.perf_counter() - start
+    start = time.perf_counter()
+    expected = [most_at_risk_city(player, unit.pos, DELIVERY_DISTANCE, step) for player in replay_game.players for unit in player.units]
+    naive_time += time.perf_counter() - start
+    assert forecasts == expected, step
+print("answers match, {:.1f}ms in total with the forecaster vs {:.1f}ms walking every city".format(forecast_time * 1000, naive_time * 1000))
+print(forecaster.report())
+
+
+# The agent now sends full workers to a city that will go dark if one is within `DELIVERY_DISTANCE`, and to the closest city tile otherwise. The way to the city at risk is read from a distance field towards its closest tile, so it goes around opponent cities and units that can't move just like `city_field` does. A worker with no way there goes to the closest city tile instead
+
+# In[54]:
+
+
+game_state = None
+resource_index = None
+spatial_index = None
+move_resolver = None
+turn_budget = None
+city_forecaster = None
+def agent(observation, configuration):
+    global game_state, resource_index, spatial_index, move_resolver, turn_budget, city_forecaster
+
+    if observation["step"] == 0:
+        turn_budget = TurnBudget()
+    turn_budget.start_turn(observation, configuration)
+
+    ### Do not edit ###
+    if observation["step"] == 0:
+        game_state = ArrayGame()
+        game_state._initialize(observation["updates"])
+        game_state._update(observation["updates"][2:])
+        game_state.id = observation.player
+    else:
+        game_state._update(observation["updates"])
+    
+    actions = []
+
+    ### AI Code goes down here! ### 
+    player = game_state.players[observation.player]
+    opponent = game_state.players[(observation.player + 1) % 2]
+    width, height = game_state.map.width, game_state.map.height
+
+    if observation["step"] == 0:
+        resource_index = ResourceIndex()
+        spatial_index = SpatialIndex(width, height)
+        move_resolver = MoveResolver()
+        city_forecaster = CityForecaster()
+    resource_index.update(observation["updates"])
+    spatial_index.update(game_state, resource_index, player)
+    city_forecaster.update(game_state, observation["step"])
+
+    resource_field, city_field, tile_fields = None, None, None
+    if turn_budget.can_afford("target_fields"):
+        with turn_budget.measure("target_fields"):
+            resource_field, city_field = target_fields(game_state.arrays, player)
+            tile_fields = TileFields(game_state.arrays, player.team)
+    
+    proposals = []
+    for unit in sorted(player.units, key=unit_priority):
+        # if the unit is a worker (can mine resources) and can perform an action this turn
+        if unit.is_worker() and unit.can_act():
+            # once we are out of time, the remaining units just walk straight towards their closest target
+            use_fields = resource_field is not None and not turn_budget.expired()
+            # we want to mine only if there is space left in the worker's cargo
+            if unit.get_cargo_space_left() > 0:
+                directions = ranked_directions_from_field(resource_field, unit.pos) if use_fields else []
+                if not directions:
+                    closest_resource_tile = spatial_index.closest_resource(unit.pos, player)
+                    if closest_resource_tile is not None:
+                        directions = [unit.pos.direction_to(closest_resource_tile.pos)]
+            else:
+                # a nearby city that would go dark gets the fuel first, as long as there is a way there
+                directions = []
+                at_risk = city_forecaster.most_at_risk(unit.pos, DELIVERY_DISTANCE, player.team)
+                if at_risk is not None and use_fields:
+                    directions = tile_fields.directions(unit.pos, at_risk[1])
+                # otherwise head to the closest citytile to drop resources to fuel the city
+                if not directions:
+                    directions = ranked_directions_from_field(city_field, unit.pos) if use_fields else []
+                if not directions:
+                    closest_city_tile = spatial_index.closest_city_tile(unit.pos)
+                    if closest_city_tile is not None:
+                        directions = [unit.pos.direction_to(closest_city_tile.pos)]
+            proposals.append((unit, directions))
+
+    if turn_budget.can_afford("resolve_moves"):
+        with turn_budget.measure("resolve_moves"):
+            actions.extend(move_resolver.resolve(game_state, player.team, proposals))
+        if move_resolver.report["conflicts"] > 0:
+            actions.append(annotate.sidetext("resolved {} move conflicts".format(move_resolver.report["conflicts"])))
+    else:
+        for unit, directions in proposals:
+            if directions and directions[0] != Constants.DIRECTIONS.CENTER:
+                actions.append(unit.move(directions[0]))
+    if turn_budget.degraded:
+        actions.append(annotate.sidetext("out of time for: {}".format(", ".join(turn_budget.degraded))))
+    
+    return actions
+
+
+# In[55]:
+
+
+results = run_matches(agent, ["simple_agent"], range(16))
+print(results[["seed", "result", "city_tiles", "mean_latency", "max_latency"]])
+
+
+# ## Sharing Out the Resource Tiles
+# 
+# Every worker still picks its own closest resource tile, so workers that start near each other all head for the same tile while other forests nobody is close to go unmined. Instead, we can hand out mining spots to all workers at once. A worker mines the tile it stands on and the four next to it, so a spot is any tile that reaches a resource tile we can mine. Only one unit can stand on a tile outside a city, so every spot takes one worker, and we look for the assignment with the most total value, where a spot is worth more the closer it is to the worker and to our nearest city, and the more resource tiles it reaches.
+# 
+# That is an assignment problem, which we solve with the auction algorithm. Each worker only bids on its `candidates` best spots, found with one NumPy matrix over the spots around the tiles in the resource index, which keeps the problem small even with hundreds of workers. Workers take turns bidding for the spot that is worth the most to them at current prices, raising its price by how much better it is than their second choice and pushing out whoever held it before. A worker stops bidding once every candidate it has left is worth more than `detour` less than its best one; it is left unassigned and moves like before.
+
+# In[56]:
+
+
+from collections import deque
+
+# candidates[i] is a list of (slot, value) for person i. Returns the slot each person gets, or None, maximising the total
+# value with each slot going to at most one person, and the number of bids it took. Person i would rather have no slot
+# than one worth less than unassigned_values[i] at its current price
+def auction_assignment(candidates, unassigned_values):
+    # with integer values, price steps below 1 / n give an optimal assignment
+    epsilon = 1.0 / (len(candidates) + 1)
+    prices = {}
+    owner = {}
+    assigned = [None] * len(candidates)
+    queue = deque(range(len(candidates)))
+    bids = 0
+    while queue:
+        i = queue.popleft()
+        best, best_value, second_value = None, unassigned_values[i], unassigned_values[i]
+        for slot, value in candidates[i]:
+            net = value - prices.get(slot, 0.0)
+            if net > best_value:
+                best, best_value, second_value = slot, net, best_value
+            elif net > second_value:
+                second_value = net
+        if best is None:
+            continue
+        bids += 1
+        prices[best] = prices.get(best, 0.0) + best_value - second_value + epsilon
+        if best in owner:
+            assigned[owner[best]] = None
+            queue.append(owner[best])
+        owner[best] = i
+        assigned[i] = best
+    return assigned, bids
+
+
+class TargetAssigner:
+    def __init__(self, candidates=8, detour=4, stickiness=3):
+        self.candidates = candidates
+        self.detour = detour
+        self.stickiness = stickiness
+        self.targets = {}
+        self.report = {}
+
+    def mining_spots(self, game_state, resource_index, player):
+        # every tile a worker can mine from, with the number of mineable tiles it reaches. City tiles are left out since
+        # any number of units can stand on them, and so are tiles the opponent is standing on
+        reach = {}
+        for x, y, r_type in resource_index.positions():
+            if r_type == Constants.RESOURCE_TYPES.COAL and not player.researched_coal(): continue
+            if r_type == Constants.RESOURCE_TYPES.URANIUM and not player.researched_uranium(): continue
+            for nx, ny in ((x, y), (x, y - 1), (x + 1, y), (x, y + 1), (x - 1, y)):
+                if 0 <= nx < game_state.map_width and 0 <= ny < game_state.map_height:
+                    reach[(nx, ny)] = reach.get((nx, ny), 0) + 1
+        blocked = {(unit.pos.x, unit.pos.y) for unit in game_state.players[(player.team + 1) % 2].units}
+        return [(pos, count) for pos, count in reach.items()
+                if game_state.map.get_cell(*pos).citytile is None and pos not in blocked]
+
+    def assign(self, game_state, workers, resource_index, player):
+        # returns {unit id: (x, y) of the tile it should mine from} for the workers that got one
+        spots = self.mining_spots(game_state, resource_index, player)
+        self.report = {"workers": len(workers), "spots": len(spots), "assigned": 0, "bids": 0}
+        if not workers or not spots:
+            return {}
+        spot_pos = np.array([pos for pos, _ in spots])
+        worker_pos = np.array([(unit.pos.x, unit.pos.y) for unit in workers])
+        # a spot is worth more the closer it is, the closer its way back to one of our cities is, and the more tiles
+        # it mines at once. Only one unit can stand on a tile that isn't a city tile, so each spot takes one worker
+        value = -np.abs(worker_pos[:, None, :] - spot_pos[None, :, :]).sum(axis=2) + np.array([count for _, count in spots])
+        city_pos = np.array([(city_tile.pos.x, city_tile.pos.y) for city in player.cities.values() for city_tile in city.citytiles])
+        if len(city_pos):
+            value -= np.abs(spot_pos[:, None, :] - city_pos[None, :, :]).sum(axis=2).min(axis=1)
+        # workers keep the spot they were given last turn unless another one is clearly better, so they don't swap
+        # spots back and forth
+        spot_index = {pos: j for j, (pos, _) in enumerate(spots)}
+        for i, unit in enumerate(workers):
+            j = spot_index.get(self.targets.get(unit.id))
+            if j is not None:
+                value[i, j] += self.stickiness
+        k = min(self.candidates, len(spots))
+        best = np.argpartition(-value, k - 1, axis=1)[:, :k]
+        candidates = [[(j, int(value[i, j])) for j in row.tolist()] for i, row in enumerate(best)]
+        # a worker that would give up more than detour of value compared to its best spot is better off following the
+        # distance field instead, which also keeps workers from bidding prices up for long
+        unassigned_values = [int(value[i, row].max()) - self.detour - 1 for i, row in enumerate(best)]
+        assigned, bids = auction_assignment(candidates, unassigned_values)
+        self.targets = {unit.id: spots[j][0] for unit, j in zip(workers, assigned) if j is not None}
+        self.report.update(assigned=len(self.targets), bids=bids)
+        return self.targets
+
+
+# the agent stops handing out spots this many turns before nightfall, see the comparison further down
+ASSIGNMENT_DUSK = 10
+
+
+# The agent assigns all workers with cargo space left in one go at the start of the turn. The value of a spot only looks at straight-line distance, so workers step straight towards their spot when nothing is in the way, and otherwise follow a distance field that goes around opponent cities and units that can't move. Those fields are built in their own budgeted stage, at most `max_fields` per turn. A worker that has no way to its spot gives it up, so it isn't held for it next turn, and mines the closest tile like before. Full workers are still sent to cities like before, since a city tile takes any number of workers. The previous agent is kept as `greedy_agent` to compare against
+
+# In[57]:
+
+
+greedy_agent = agent
+
+game_state = None
+resource_index = None
+spatial_index = None
+move_resolver = None
+turn_budget = None
+city_forecaster = None
+target_assigner = None
+def agent(observation, configuration):
+    global game_state, resource_index, spatial_index, move_resolver, turn_budget, city_forecaster, target_assigner
+
+    if observation["step"] == 0:
+        turn_budget = TurnBudget()
+    turn_budget.start_turn(observation, configuration)
+
+    ### Do not edit ###
+    if observation["step"] == 0:
+        game_state = ArrayGame()
+        game_state._initialize(observation["updates"])
+        game_state._update(observation["updates"][2:])
+        game_state.id = observation.player
+    else:
+        game_state._update(observation["updates"])
+    
+    actions = []
+
+    ### AI Code goes down here! ### 
+    player = game_state.players[observation.player]
+    opponent = game_state.players[(observation.player + 1) % 2]
+    width, height = game_state.map.width, game_state.map.height
+
+    if observation["step"] == 0:
+        resource_index = ResourceIndex()
+        spatial_index = SpatialIndex(width, height)
+        move_resolver = MoveResolver()
+        city_forecaster = CityForecaster()
+        target_assigner = TargetAssigner()
+    resource_index.update(observation["updates"])
+    spatial_index.update(game_state, resource_index, player)
+    city_forecaster.update(game_state, observation["step"])
+
+    resource_field, city_field, tile_fields = None, None, None
+    if turn_budget.can_afford("target_fields"):
+        with turn_budget.measure("target_fields"):
+            resource_field, city_field = target_fields(game_state.arrays, player)
+            tile_fields = TileFields(game_state.arrays, player.team)
+
+    # a worker sent to a spot far from our cities late in the day gets caught out in the dark, and at night a worker
+    # walking out with an empty cargo burns through its fuel, so we only share out spots until shortly before night and
+    # let workers mine the closest tile after that
+    targets = {}
+    if turns_until_night(observation["step"]) > ASSIGNMENT_DUSK and turn_budget.can_afford("assign_targets"):
+        with turn_budget.measure("assign_targets"):
+            miners = [unit for unit in player.units if unit.is_worker() and unit.can_act() and unit.get_cargo_space_left() > 0]
+            targets = target_assigner.assign(game_state, miners, resource_index, player)
+    # the way to each spot is its own stage, so the budget sees what the distance fields around obstacles cost
+    routes = {}
+    if targets and tile_fields is not None and turn_budget.can_afford("route_targets"):
+        with turn_budget.measure("route_targets"):
+            routes = {unit.id: tile_fields.directions(unit.pos, targets[unit.id]) for unit in player.units if unit.id in targets}
+    
+    proposals = []
+    for unit in sorted(player.units, key=unit_priority):
+        # if the unit is a worker (can mine resources) and can perform an action this turn
+        if unit.is_worker() and unit.can_act():
+            # once we are out of time, the remaining units just walk straight towards their closest target
+            use_fields = resource_field is not None and not turn_budget.expired()
+            # we want to mine only if there is space left in the worker's cargo
+            if unit.get_cargo_space_left() > 0:
+                directions = []
+                if unit.id in targets:
+                    # walk to the spot around anything in the way. A worker with no way there gives its spot up, so
+                    # it isn't kept for it next turn, and mines the closest tile instead
+                    directions = routes[unit.id] if unit.id in routes else directions_towards(unit.pos, targets[unit.id])
+                    if not directions:
+                        target_assigner.targets.pop(unit.id, None)
+                if not directions:
+                    directions = ranked_directions_from_field(resource_field, unit.pos) if use_fields else []
+                if not directions:
+                    closest_resource_tile = spatial_index.closest_resource(unit.pos, player)
+                    if closest_resource_tile is not None:
+                        directions = [unit.pos.direction_to(closest_resource_tile.pos)]
+            else:
+                # a nearby city that would go dark gets the fuel first, as long as there is a way there
+                directions = []
+                at_risk = city_forecaster.most_at_risk(unit.pos, DELIVERY_DISTANCE, player.team)
+                if at_risk is not None and use_fields:
+                    directions = tile_fields.directions(unit.pos, at_risk[1])
+                # otherwise head to the closest citytile to drop resources to fuel the city
+                if not directions:
+                    directions = ranked_directions_from_field(city_field, unit.pos) if use_fields else []
+                if not directions:
+                    closest_city_tile = spatial_index.closest_city_tile(unit.pos)
+                    if closest_city_tile is not None:
+                        directions = [unit.pos.direction_to(closest_city_tile.pos)]
+            proposals.append((unit, directions))
+
+    if turn_budget.can_afford("resolve_moves"):
+        with turn_budget.measure("resolve_moves"):
+            actions.extend(move_resolver.resolve(game_state, player.team, proposals))
+        if move_resolver.report["conflicts"] > 0:
+            actions.append(annotate.sidetext("resolved {} move conflicts".format(move_resolver.report["conflicts"])))
+    else:
+        for unit, directions in proposals:
+            if directions and directions[0] != Constants.DIRECTIONS.CENTER:
+                actions.append(unit.move(directions[0]))
+    if turn_budget.degraded:
+        actions.append(annotate.sidetext("out of time for: {}".format(", ".join(turn_budget.degraded))))
+    
+    return actions
+
+
+# To compare the two agents on how much they mine, we play them in the simulator, which keeps count of the resources each team collects. `play_in_simulator` feeds agents the same observations the engine would, and can change the starting position first. Our agent never builds more city tiles, so it only ever has its one worker and there is nothing to share out. For the comparison we start it with 20 workers on its city tile instead
+
+# In[58]:
+
+
+from kaggle_environments.envs.lux_ai_2021.agents import agents as builtin_agents
+from kaggle_environments.utils import structify
+
+def play_in_simulator(agents, seed, size=None, episode_steps=361, setup=None):
+    agents = [builtin_agents[a] if isinstance(a, str) else a for a in agents]
+    sim = LuxSim(initial_updates(seed, size), episode_steps)
+    if setup is not None:
+        setup(sim)
+    updates = list(initial_updates(seed, size)[:2]) + sim.updates()
+    configuration = structify({"episodeSteps": episode_steps, "actTimeout": 3})
+    while True:
+        actions = []
+        for player, player_agent in enumerate(agents):
+            observation = structify({"step": sim.turn, "player": player, "updates": updates, "remainingOverageTime": 60,
+                                     "width": sim.width, "height": sim.height})
+            actions.append(player_agent(observation, configuration))
+        sim.step(actions)
+        if sim.done:
+            return sim
+        updates = sim.updates()
+
+# extra workers for team on its first city tile
+def add_workers(team, count):
+    def setup(sim):
+        x, y = next(pos for pos, tile in sim.city_tiles.items() if tile.team == team)
+        for _ in range(count):
+            sim._spawn_unit(team, Constants.UNIT_TYPES.WORKER, x, y)
+    return setup
+
+def fuel_collected(sim, team):
+    return sum(amount * GAME_CONSTANTS["PARAMETERS"]["RESOURCE_TO_FUEL_RATE"][r_type.upper()] for r_type, amount in sim.collected[team].items())
+
+rows = []
+dusk = ASSIGNMENT_DUSK
+for seed in range(16):
+    # "until night" hands out spots right up to nightfall
+    for name, candidate, ASSIGNMENT_DUSK in [("greedy", greedy_agent, dusk), ("until night", agent, 0), ("assignment", agent, dusk)]:
+        # the first day, before any worker has had to survive a night, and the whole game
+        for episode_steps in [31, 361]:
+            sim = play_in_simulator([candidate, "simple_agent"], seed, episode_steps=episode_steps, setup=add_workers(0, 19))
+            rows.append({"seed": seed, "agent": name, "turns": "first day" if episode_steps == 31 else "whole game",
+                         "fuel_collected": fuel_collected(sim, 0), "workers_left": len(sim.units[0])})
+ASSIGNMENT_DUSK = dusk
+comparison = pd.DataFrame(rows)
+print(comparison.groupby(["turns", "agent"])[["fuel_collected", "workers_left"]].mean())
+
+
+# Handing out spots right up to nightfall ("until night") mines about 5% more than greedy during the first day, but over a whole game it does worse: 6452 against 6547 fuel, with half as many workers left at the end (0.5 against 1.25). A worker still walking to a spot far from our cities when it gets dark is caught out with nothing to burn. That is why the agent stops handing out spots `ASSIGNMENT_DUSK` turns before night. It gives up a little of the first-day gain, about 4% more than greedy instead of 5%, and over a whole game it collects about 5% more fuel than greedy (6903 against 6547). It still ends with slightly fewer workers than greedy, 1.06 against 1.25. Most workers die in the first night with any of these agents, since none of them makes sure its workers are near a city or carrying fuel when it gets dark, so the whole-game numbers come down to a handful of survivors and vary a lot between games.
+# 
+# Finally, the assignment has to be quick enough to run every turn with many more workers. Here it is with 300 workers spread over a 32x32 map
+
+# In[59]:
+
+
+rng = np.random.default_rng(0)
+sim = LuxSim(initial_updates(562124210))
+free_tiles = [(x, y) for y in range(sim.height) for x in range(sim.width) if (x, y) not in sim.city_tiles]
+for i in rng.choice(len(free_tiles), 300, replace=False):
+    sim._spawn_unit(0, Constants.UNIT_TYPES.WORKER, *free_tiles[i])
+updates = list(initial_updates(562124210)[:2]) + sim.updates()
+crowded_game = Game()
+crowded_game._initialize(updates)
+crowded_game._update(updates[2:])
+crowded_index = ResourceIndex()
+crowded_index.update(updates)
+assigner = TargetAssigner()
+start = time.perf_counter()
+targets = assigner.assign(crowded_game, crowded_game.players[0].units, crowded_index, crowded_game.players[0])
+print(assigner.report, "in {:.1f}ms".format((time.perf_counter() - start) * 1000))
+
+
+# ## Catching Slowdowns Before They Ship
+# 
+# We have changed the agent many times in this notebook, and each time we checked by hand that it didn't get slower or weaker. The benchmark below does those checks the same way every time, so they can be rerun after every change.
+# 
+# It has two parts. The microbenchmarks time the helpers the agent calls every turn on saved game states: a mid-game and a late-game day turn on each map size from 12 to 32, so the agent hands out mining spots on all of them. Our agent never builds, so a real game only ever has a couple of units, which would leave the helpers that loop over units with nothing to do. The states are played in the simulator with extra workers and then filled with workers of both teams, up to 256 on the largest map. The turn before each of them is saved too, and the agent is set up on that turn before every timed call, so it has to pick up what changed like it would in a game instead of finding everything cached. They are saved once as update lines in `benchmark_states.json`, so every later run times exactly the same positions. The macro benchmark plays our agent against `simple_agent` and `random_agent` on fixed seeds and reports turns per second, the agent's mean latency and its score, where a draw counts as half a win. Every game against `simple_agent` is a draw, so a win rate against it alone would stay at zero whatever the agent did.
+# 
+# Results are written to a JSON baseline. `check_benchmark` compares a new run with the baseline and raises an error if a helper got slower by more than `threshold` across the saved states, if the games got slower to play, or if the score dropped by more than `score_tolerance`. Kaggle notebooks run on shared machines where the same code can easily take 30% longer from one run to the next, so the default threshold is set at 50% to catch real slowdowns without failing on noise. On a quiet machine it can be lowered.
+
+# In[60]:
+
+
+import timeit
+
+BENCHMARK_SIZES = [12, 16, 24, 32]
+# both are day turns, so the agent hands out mining spots on them
+BENCHMARK_PHASES = {"mid": 140, "late": 300}
+# share of the tiles that get a worker of each team in a saved state, so a late state on the 32x32 map has 256 of them
+BENCHMARK_CROWDING = {"mid": 1 / 16, "late": 1 / 8}
+BENCHMARK_SEEDS = list(range(8))
+BENCHMARK_OPPONENTS = ["simple_agent", "random_agent"]
+
+# plays a game in the simulator up to a mid-game and a late-game turn on each map size and saves the update lines of
+# that turn and the one before, as seen by player 0. Neither agent builds anything, so our agent starts with extra
+# workers to mine the map down, and workers of both teams are spread over the free tiles on the turn before, as many as
+# a game where both teams grow would have by then
+def capture_benchmark_states(path, agent, seed=562124210, workers=20):
+    rng = np.random.default_rng(seed)
+    configuration = structify({"episodeSteps": 361, "actTimeout": 3})
+    states = []
+    for size in BENCHMARK_SIZES:
+        header = list(initial_updates(seed, size)[:2])
+        for phase, step in BENCHMARK_PHASES.items():
+            sim = play_in_simulator([agent, "simple_agent"], seed, size=size, episode_steps=step, setup=add_workers(0, workers))
+            occupied = set(sim.city_tiles) | {(unit.x, unit.y) for team_units in sim.units for unit in team_units.values()}
+            free_tiles = [(x, y) for y in range(size) for x in range(size) if (x, y) not in occupied]
+            count = int(size * size * BENCHMARK_CROWDING[phase])
+            spread = rng.choice(len(free_tiles), 2 * count, replace=False)
+            for team, tiles in enumerate((spread[:count], spread[count:])):
+                for i in tiles:
+                    sim._spawn_unit(team, Constants.UNIT_TYPES.WORKER, *free_tiles[i])
+            # both agents play one more turn from there. A game that ended early gives its last two turns instead
+            previous = sim.updates()
+            sim.step([player_agent(structify({"step": sim.turn, "player": player, "updates": previous, "remainingOverageTime": 60,
+                                              "width": size, "height": size}), configuration)
+                      for player, player_agent in enumerate([agent, builtin_agents["simple_agent"]])])
+            states.append({"size": size, "phase": phase, "step": sim.turn, "previous_updates": header + previous,
+                           "updates": header + sim.updates()})
+    with open(path, "w") as f:
+        json.dump(states, f)
+    return states
+
+def load_benchmark_state(state):
+    # every turn's updates describe the whole map, so a single turn is enough to rebuild the Game
+    game_state = ArrayGame()
+    game_state._initialize(state["updates"])
+    game_state._update(state["updates"][2:])
+    game_state.id = 0
+    return game_state
+
+# seconds per call of fn. Each measurement runs fn often enough to take about 0.05s, and we keep the fastest one since
+# anything slower than that was the machine doing something else. A setup runs untimed before every measurement, which
+# is then a single call of fn
+def time_call(fn, repeat=7, setup=None):
+    if setup is not None:
+        return min(timeit.Timer(fn, setup=setup).repeat(repeat=repeat, number=1))
+    timer = timeit.Timer(fn)
+    number = max(1, int(timer.autorange()[0] * 0.25))
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+def benchmark_helpers(state):
+    game_state = load_benchmark_state(state)
+    player = game_state.players[0]
+    units = [unit for p in game_state.players for unit in p.units]
+    lines = state["updates"][2:]
+    index = ResourceIndex()
+    index.update(lines)
+    resource_tiles = find_resources(game_state)
+    # every unit that can act heads down the distance fields, like the agent's workers do
+    resource_field, city_field = target_fields(game_state.arrays, player)
+    proposals = [(unit, ranked_directions_from_field(resource_field if unit.get_cargo_space_left() > 0 else city_field, unit.pos))
+                 for unit in sorted(player.units, key=unit_priority) if unit.can_act()]
+    observation = structify({"step": state["step"], "player": 0, "updates": lines, "remainingOverageTime": 60})
+    configuration = structify({"episodeSteps": 361, "actTimeout": 3})
+    # calling the agent twice on the same turn would find nothing changed and every cache warm, so before each timed call
+    # it sets itself up on the turn before, as its first turn, and is then timed on the turn that followed
+    first_observation = structify({"step": 0, "player": 0, "updates": state["previous_updates"], "remainingOverageTime": 60})
+    setups = {"agent": lambda: agent(first_observation, configuration)}
+    helpers = {
+        "find_resources": lambda: find_resources(game_state),
+        "find_closest_resources": lambda: [find_closest_resources(unit.pos, player, resource_tiles) for unit in units],
+        "find_closest_city_tile": lambda: [find_closest_city_tile(unit.pos, player) for unit in units],
+        "resource_index": lambda: ResourceIndex().update(lines),
+        "target_fields": lambda: target_fields(game_state.arrays, player),
+        "assign_targets": lambda: TargetAssigner().assign(game_state, player.units, index, player),
+        "resolve_moves": lambda: MoveResolver().resolve(game_state, player.team, proposals),
+        "agent": lambda: agent(observation, configuration),
+    }
+    return {"{}/{}/{}".format(name, state["size"], state["phase"]): time_call(fn, setup=setups.get(name)) for name, fn in helpers.items()}
+
+def benchmark_matches(agent, seeds=BENCHMARK_SEEDS, opponents=BENCHMARK_OPPONENTS):
+    # played one after the other in this process, so turns per second isn't affected by how busy the machine's other cores are
+    start = time.perf_counter()
+    results = pd.DataFrame([play_match((agent, opponent, seed)) for opponent in opponents for seed in seeds])
+    elapsed = time.perf_counter() - start
+    # a draw counts as half a win. Our agent draws every game against simple_agent and wins every game against
+    # random_agent, so the score drops as soon as it loses or draws a game it used to get more out of
+    score = results["result"].map({"win": 1.0, "draw": 0.5, "loss": 0.0})
+    return {
+        "macro/turns_per_second": float(results["turns"].sum() / elapsed),
+        "macro/mean_latency": float(results["mean_latency"].mean()),
+        "macro/score": float(score.mean()),
+    }
+
+def run_benchmark(states_path="benchmark_states.json", seeds=BENCHMARK_SEEDS):
+    with open(states_path) as f:
+        states = json.load(f)
+    results = {}
+    for state in states:
+        results.update(benchmark_helpers(state))
+    results.update(benchmark_matches(agent, seeds))
+    return results
+
+def save_baseline(results, path="benchmark_baseline.json"):
+    with open(path, "w") as f:
+        json.dump({"created": time.strftime("%Y-%m-%d %H:%M:%S"), "results": results}, f, indent=1, sort_keys=True)
+
+# compares results with the baseline and raises an error listing everything that regressed. Single timings are too
+# noisy to fail on, so each helper is judged on its geometric mean change over all saved states
+def check_benchmark(results, path="benchmark_baseline.json", threshold=0.5, score_tolerance=0.05):
+    with open(path) as f:
+        baseline = json.load(f)["results"]
+    timings = {}
+    for name, value in results.items():
+        if name in baseline and not name.startswith("macro/") and baseline[name] > 0:
+            timings.setdefault(name.split("/")[0], []).append((baseline[name], value))
+    rows = []
+    for helper, pairs in timings.items():
+        before, value = np.exp(np.log(pairs).mean(axis=0))
+        rows.append({"benchmark": helper, "baseline": before, "current": value, "change": value / before - 1, "regressed": value > before * (1 + threshold)})
+    for name, value in results.items():
+        if name.startswith("macro/") and name in baseline:
+            before = baseline[name]
+            if name == "macro/score":
+                regressed = value < before - score_tolerance
+            elif name == "macro/turns_per_second":
+                regressed = value < before * (1 - threshold)
+            else:
+                regressed = value > before * (1 + threshold)
+            rows.append({"benchmark": name, "baseline": before, "current": value, "change": value / before - 1 if before else 0.0, "regressed": regressed})
+    report = pd.DataFrame(rows)
+    regressions = report[report["regressed"]]
+    if len(regressions):
+        raise RuntimeError("benchmark regressions:\n" + regressions.to_string(index=False))
+    return report
+
+
+# The first run captures the states and writes the baseline. After that, rerunning the last two lines after a change checks it against the baseline
+
+# In[61]:
+
+
+if not os.path.exists("benchmark_states.json"):
+    capture_benchmark_states("benchmark_states.json", agent)
+results = run_benchmark()
+if not os.path.exists("benchmark_baseline.json"):
+    save_baseline(results)
+report = check_benchmark(results)
+print(report.to_string(index=False))